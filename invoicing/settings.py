@@ -76,6 +76,32 @@ EVENTBRITE_TAX_INFORMATION = {
     }
 }
 
+# Seconds a billing auth token is reused when the token service doesn't say when it expires
+BILLING_TOKEN_TTL = 300
+
+# Number of create_tax_receipt actions sent in a single billing job
+TAX_RECEIPTS_BATCH_TO_GENERATE = 50
+
+# Number of tax receipt ids sent in a single declare_tax_receipts job
+TAX_RECEIPTS_BATCH_TO_DECLARE = 100
+
+# Bounds of the batch size of declare_pending_tax_receipts --adaptive_batch, it shrinks when a job
+# takes longer than the target latency in seconds
+TAX_RECEIPTS_BATCH_TO_DECLARE_MIN = 10
+TAX_RECEIPTS_BATCH_TO_DECLARE_MAX = 1000
+TAX_RECEIPTS_DECLARE_TARGET_LATENCY = 10
+
+# Attempts of a declare_tax_receipts job before its batch is split, and seconds of the first backoff
+TAX_RECEIPTS_DECLARE_ATTEMPTS = 3
+TAX_RECEIPTS_DECLARE_BACKOFF = 1
+
+# Tax receipt ids that could not be declared, used by declare_pending_tax_receipts --retry_failed
+TAX_RECEIPTS_DECLARE_FAILED_FILE = os.path.join(BASE_DIR, 'tax_receipts_declare_failed.ndjson')
+
+# Last event processed by each generation phase and the batches accepted by each declaration,
+# used by generate_entry_point --resume and declare_pending_tax_receipts --resume
+TAX_RECEIPTS_CHECKPOINT_FILE = os.path.join(BASE_DIR, 'tax_receipts_checkpoints.json')
+
 ROOT_URLCONF = 'invoicing.urls'
 
 TEMPLATES = [
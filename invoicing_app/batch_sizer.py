@@ -0,0 +1,43 @@
+import threading
+
+
+class AdaptiveBatchSizer(object):
+    """
+        Batch size that follows the latency of the jobs sent with it (AIMD): it grows
+        by increase after a full batch answered in less than target_latency seconds
+        and it is multiplied by decrease after a job that failed or was slower.
+        The size is always kept between minimum and maximum.
+    """
+    DECREASE = 0.5
+
+    def __init__(self, initial, minimum, maximum, target_latency, increase=None, decrease=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.increase = increase if increase else max(1, initial // 10)
+        self.decrease = decrease if decrease else self.DECREASE
+        self.size = self._bounded(initial)
+        self.sizes = [self.size]
+        self._lock = threading.Lock()
+
+    def record(self, batch_size, seconds, error=False):
+        """
+            Adapt the size to a job of batch_size ids. Returns the new size when it
+            changed, None otherwise.
+        """
+        with self._lock:
+            if error or seconds > self.target_latency:
+                size = self._bounded(int(self.size * self.decrease))
+            elif batch_size >= self.size:
+                # Smaller batches (the last page or a split one) say nothing about a bigger size
+                size = self._bounded(self.size + self.increase)
+            else:
+                size = self.size
+            if size == self.size:
+                return None
+            self.size = size
+            self.sizes.append(size)
+            return size
+
+    def _bounded(self, size):
+        return min(self.maximum, max(self.minimum, size))
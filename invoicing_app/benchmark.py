@@ -0,0 +1,315 @@
+from datetime import timedelta
+from timeit import default_timer
+import json
+import random
+import socket
+import SocketServer
+import threading
+
+from decimal import Decimal
+
+from django.db.models import Max
+from django.utils import timezone
+from memory_profiler import memory_usage
+
+from invoicing import settings
+from invoicing_app.models import (
+    ORDER_PLACED,
+    Event,
+    Order,
+    PaymentOptions,
+    User,
+)
+from invoicing_app.tax_receipt_generator import (
+    PARENT_CHILD_MASKS,
+    PHASE_CHILD,
+    PHASE_NO_SERIES,
+    TaxReceiptGenerator,
+    TaxReceiptGeneratorRequest,
+)
+
+BULK_SIZE = 5000
+# Seconds between the memory samples
+MEMORY_INTERVAL = 0.01
+
+
+class GenerationBenchmark(object):
+    """
+        Build a synthetic dataset of placed orders in the period of today_date and
+        time each stage of the generation against it in dry run.
+        series_ratio of the events are series with children_per_series children,
+        the orders go to the no series and child events.
+    """
+
+    def __init__(
+            self,
+            orders,
+            country='AR',
+            today_date='2020-04-01',
+            orders_per_event=25,
+            series_ratio=0.2,
+            children_per_series=4,
+            seed=0
+    ):
+        self.orders = orders
+        self.country = country
+        self.today_date = today_date
+        self.orders_per_event = orders_per_event
+        self.series_ratio = series_ratio
+        self.children_per_series = children_per_series
+        self.random = random.Random(seed)
+        self.request = TaxReceiptGeneratorRequest(
+            country=country,
+            today_date=today_date,
+            user_id=None,
+            event_id=None,
+        )
+        self.events = 0
+
+    def build_dataset(self):
+        user = User.objects.create(first_name='BENCHMARK')
+        next_id = (Event.objects.aggregate(last_id=Max('id'))['last_id'] or 0) + 1
+        events = []
+        payment_options = []
+        order_events = []
+
+        while len(order_events) < max(1, self.orders // self.orders_per_event):
+            event_id = next_id
+            next_id += 1
+            series = self.random.random() < self.series_ratio
+            events.append(self.build_event(event_id, user, series=series))
+            payment_options.append(self.build_payment_options(event_id))
+            if not series:
+                order_events.append(event_id)
+                continue
+            for _ in range(self.children_per_series):
+                events.append(self.build_event(next_id, user, series=True, event_parent_id=event_id))
+                order_events.append(next_id)
+                next_id += 1
+
+        Event.objects.bulk_create(events, batch_size=BULK_SIZE)
+        PaymentOptions.objects.bulk_create(payment_options, batch_size=BULK_SIZE)
+        self.events = len(events)
+
+        # Orders paid a day inside the period so the timezone never moves them out
+        first_day = self.request.period_start + timedelta(days=1)
+        seconds = int((self.request.period_end - first_day).total_seconds()) - 24 * 60 * 60
+        orders = []
+        for _ in range(self.orders):
+            pp_date = first_day + timedelta(seconds=self.random.randint(0, seconds))
+            orders.append(
+                Order(
+                    event_id=self.random.choice(order_events),
+                    status=ORDER_PLACED,
+                    pp_date=self.make_aware(pp_date),
+                    changed=self.make_aware(pp_date + timedelta(minutes=self.random.randint(0, 60))),
+                    gross=Decimal(self.random.randint(10, 9999)).scaleb(-1),
+                    mg_fee=Decimal(self.random.randint(1, 999)).scaleb(-1),
+                    eb_tax=Decimal(self.random.randint(0, 99)).scaleb(-1),
+                )
+            )
+            if len(orders) == BULK_SIZE:
+                Order.objects.bulk_create(orders)
+                orders = []
+        Order.objects.bulk_create(orders)
+
+    def build_event(self, event_id, user, series=False, event_parent_id=None):
+        return Event(
+            id=event_id,
+            event_name='BENCHMARK_{}'.format(event_id)[:20],
+            series=series,
+            user=user,
+            event_parent_id=event_parent_id,
+            currency='ARS' if self.country == 'AR' else 'BRL',
+        )
+
+    def build_payment_options(self, event_id):
+        return PaymentOptions(
+            event_id=event_id,
+            epp_country=self.country,
+            accept_eventbrite=True,
+            epp_name_on_account='BENCHMARK',
+            epp_address1='address 1',
+            epp_zip='1000',
+            epp_city='city',
+            epp_state='state',
+            epp_tax_identifier='20123456789',
+        )
+
+    def make_aware(self, date):
+        if settings.USE_TZ:
+            return timezone.make_aware(date, timezone.utc)
+        return date
+
+    def measure(self):
+        """
+            Seconds spent by each stage: the queries of both phases, building the
+            payloads, iterating the results and the whole dry run.
+            Also the peak MiB over the process start of holding the rows of both
+            phases, as GenerationRow and as dicts, and of the whole dry run.
+        """
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False)
+        localize_start_date = generator.localize_date(self.country, self.request.period_start)
+        localize_end_date = generator.localize_date(self.country, self.request.period_end)
+        query_options = {
+            'localize_end_date_query': localize_end_date,
+            'localize_start_date_query': localize_start_date,
+            'declarable_tax_receipt_countries_query': self.country,
+            'status_query': 100,
+        }
+
+        started = default_timer()
+        rows = self.fetch_rows(generator, query_options)
+        query_time = default_timer() - started
+
+        # GenerationRow first, memory freed by one measure can be reused by the next
+        rows_memory = self.peak_memory(self.fetch_rows, generator, query_options)
+        dict_rows_memory = self.peak_memory(self.fetch_rows, generator, query_options, True)
+
+        started = default_timer()
+        for row in rows:
+            generator.build_tax_receipt_payload(row, localize_start_date, localize_end_date)
+        payload_time = default_timer() - started
+
+        started = default_timer()
+        generator.iterate_querys_results(rows, localize_start_date, localize_end_date)
+        iteration_time = default_timer() - started
+
+        # memory_usage runs the function again when it ends before a few samples
+        usage, (end_to_end_generator, end_to_end_time) = memory_usage(
+            (self.time_run, ()), interval=MEMORY_INTERVAL, retval=True
+        )
+        end_to_end_memory = max(usage) - usage[0]
+
+        return {
+            'orders': self.orders,
+            'events': self.events,
+            'rows': len(rows),
+            'tax_receipts': end_to_end_generator.cont_tax_receipts,
+            'query_time': query_time,
+            'payload_time': payload_time,
+            'iteration_time': iteration_time,
+            'end_to_end_time': end_to_end_time,
+            'rows_memory': rows_memory,
+            'dict_rows_memory': dict_rows_memory,
+            'end_to_end_memory': end_to_end_memory,
+        }
+
+    def fetch_rows(self, generator, query_options, as_dicts=False):
+        rows = []
+        for phase in (PHASE_NO_SERIES, PHASE_CHILD):
+            query = generator.query.format(condition_mask='', parent_child_mask=PARENT_CHILD_MASKS[phase])
+            for row in generator.get_query_results(query_options, query):
+                rows.append(dict(zip(row._fields, row)) if as_dicts else row)
+        return rows
+
+    def peak_memory(self, function, *args):
+        """
+            Peak MiB of the process while function runs, over the MiB when it starts
+        """
+        usage = memory_usage((function, args), interval=MEMORY_INTERVAL)
+        return max(usage) - usage[0]
+
+    def time_run(self):
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False)
+        started = default_timer()
+        generator.run(self.request)
+        return generator, default_timer() - started
+
+
+class BillingStub(object):
+    """
+        Local stand-in for the billing service: a TCP server on localhost that
+        answers every job with one successful action per tax receipt. Clients
+        connect when they are created, as the billing clients do, but without TLS,
+        so the cost of a new client is a lower bound of the real one.
+    """
+
+    def __init__(self):
+        self.server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0), BillingStubHandler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Client(self, service):
+        return BillingStubClient(self.server.server_address)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def measure(self, jobs, receipts_per_job=50):
+        """
+            Seconds per job sending jobs of receipts_per_job tax receipts with a new
+            client for each job, as the generation did, and with one client reused by
+            every job, as it does now.
+        """
+        started = default_timer()
+        for _ in range(jobs):
+            client = self.Client('billing')
+            client.send_job(self.build_job(client, receipts_per_job))
+            client.close()
+        new_client_time = (default_timer() - started) / jobs
+
+        started = default_timer()
+        client = self.Client('billing')
+        for _ in range(jobs):
+            client.send_job(self.build_job(client, receipts_per_job))
+        client.close()
+        reused_client_time = (default_timer() - started) / jobs
+
+        return {
+            'billing_jobs': jobs,
+            'billing_new_client_time': new_client_time,
+            'billing_reused_client_time': reused_client_time,
+        }
+
+    def build_job(self, client, receipts):
+        job = client.new_job()
+        for event_id in range(receipts):
+            job.create_tax_receipt(tax_receipt={'event_id': str(event_id)})
+        return job
+
+
+class BillingStubHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            actions = len(json.loads(line)['actions'])
+            self.wfile.write(json.dumps({'actions': [{'error_detail': None}] * actions}) + '\n')
+            self.wfile.flush()
+
+
+class BillingStubClient(object):
+    def __init__(self, address):
+        self._socket = socket.create_connection(address)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._socket.makefile('rwb')
+
+    def new_job(self):
+        return BillingStubJob()
+
+    def send_job(self, job):
+        self._file.write(json.dumps({'actions': job.actions}) + '\n')
+        self._file.flush()
+        return BillingStubResponse(json.loads(self._file.readline())['actions'])
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+class BillingStubJob(object):
+    def __init__(self):
+        self.actions = []
+
+    def create_tax_receipt(self, **kwargs):
+        self.actions.append(kwargs)
+
+
+class BillingStubResponse(object):
+    def __init__(self, actions):
+        self.actions = actions
+
+    def is_error(self):
+        return False
@@ -0,0 +1,105 @@
+from collections import deque
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import tempfile
+import threading
+
+
+class CheckpointStore(object):
+    """
+        Small JSON file that keeps the progress of the management commands between
+        runs. Values are stored under a key built from the given parts, for example
+        (country, period, phase). Several commands share the file, every change is
+        made holding an exclusive lock on <path>.lock so concurrent processes never
+        overwrite the keys of each other.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def get(self, *key):
+        with self._lock:
+            return self._read().get(self._key(key))
+
+    def set(self, value, *key):
+        with self._locked():
+            data = self._read()
+            data[self._key(key)] = value
+            self._write(data)
+
+    def delete(self, *key):
+        with self._locked():
+            data = self._read()
+            if data.pop(self._key(key), None) is not None:
+                self._write(data)
+
+    @contextmanager
+    def _locked(self):
+        # The file itself is replaced on every write, the lock is kept on another one
+        with self._lock:
+            with open('{}.lock'.format(self.path), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def _write(self, data):
+        # Write to a temporary file first so a crash never leaves a truncated file, with
+        # a unique name so other processes writing the same file don't share it
+        directory, name = os.path.split(os.path.abspath(self.path))
+        tmp_fd, tmp_path = tempfile.mkstemp(prefix='{}.'.format(name), suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(tmp_fd, 'w') as checkpoint_file:
+                json.dump(data, checkpoint_file, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _key(self, key):
+        return '|'.join(str(part) for part in key)
+
+
+class CheckpointTracker(object):
+    """
+        Follow events processed out of order (concurrent or batched dispatch) and
+        expose the last event id of the processed prefix, in the order events
+        were read, and the ids of the events that failed. A resumed run starts from
+        the last_event_id and the failed ids of the previous one.
+    """
+
+    def __init__(self, last_event_id=None, failed=()):
+        self.last_event_id = last_event_id
+        self.failed = set(failed)
+        self._pending = deque()
+        self._done = set()
+        self._lock = threading.Lock()
+
+    def start(self, event_id):
+        with self._lock:
+            self._pending.append(event_id)
+
+    def finish(self, event_id, failed=False):
+        with self._lock:
+            if failed:
+                self.failed.add(event_id)
+            else:
+                self.failed.discard(event_id)
+            self._done.add(event_id)
+            while self._pending and self._pending[0] in self._done:
+                event_id = self._pending.popleft()
+                self._done.discard(event_id)
+                # The failed events retried by a resumed run come before its last_event_id
+                if self.last_event_id is None or event_id > self.last_event_id:
+                    self.last_event_id = event_id
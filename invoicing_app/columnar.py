@@ -0,0 +1,27 @@
+try:
+    import numpy
+except ImportError:
+    # Optional, generate_entry_point --columnar needs it
+    numpy = None
+
+
+def chunk_amounts(rows):
+    """
+        Base and taxable amounts in cents of a chunk of ColumnarGenerationRow. The
+        query already sums the amounts in cents, so no Decimal is converted and the
+        taxable amounts of the whole chunk are computed at once over int64 arrays.
+        The result is the same as int(amount * 100) on each Decimal of the row, the
+        money columns have two decimals at most.
+        Returns None when some amount is missing, the caller computes those rows one
+        by one.
+    """
+    if not rows:
+        return None
+    base = [row.base_cents for row in rows]
+    with_tax = [row.total_taxable_with_tax_cents for row in rows]
+    tax = [row.total_tax_cents for row in rows]
+    if None in base or None in with_tax or None in tax:
+        return None
+
+    taxable = numpy.array(with_tax, dtype=numpy.int64) - numpy.array(tax, dtype=numpy.int64)
+    return zip(base, taxable.tolist())
@@ -0,0 +1,59 @@
+import gzip
+import json
+import os
+import threading
+
+
+class NdjsonSink(object):
+    """
+        Write the dry run payloads to a newline delimited JSON file as they are
+        generated, one {"event_id": ..., "payload": ...} per line. The file is
+        gzip compressed when the path ends with .gz. The file is truncated when the
+        sink is created, so a run without payloads leaves an empty file instead of
+        the one of a previous run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.written = 0
+        self._file = open_ndjson(self.path, 'wb')
+        self._lock = threading.Lock()
+
+    def write(self, event_id, payload):
+        line = json.dumps({'event_id': event_id, 'payload': payload}, sort_keys=True)
+        with self._lock:
+            self._file.write(line + '\n')
+            self.written += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def open_ndjson(path, mode='rb'):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def read_ndjson(path):
+    """
+        Yield the (event_id, payload) written by NdjsonSink, one line at a time.
+    """
+    with open_ndjson(path) as ndjson_file:
+        for line in ndjson_file:
+            if line.strip():
+                item = json.loads(line)
+                yield item['event_id'], item['payload']
+
+
+def shard_path(path, shard_index):
+    """
+        Output file of a shard: output.ndjson.gz -> output.shard-1.ndjson.gz
+    """
+    directory, name = os.path.split(path)
+    parts = name.split('.', 1)
+    parts.insert(1, 'shard-{}'.format(shard_index))
+    return os.path.join(directory, '.'.join(parts))
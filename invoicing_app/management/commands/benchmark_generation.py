@@ -0,0 +1,129 @@
+from datetime import datetime
+import json
+import os
+
+from django.core.management.base import (
+    BaseCommand,
+    CommandError
+)
+from django.db import transaction
+from optparse import make_option
+
+from invoicing import settings
+from invoicing_app.benchmark import (
+    BillingStub,
+    GenerationBenchmark,
+)
+
+
+class Command(BaseCommand):
+    help = ('Time the tax receipts generation against synthetic datasets. Use a scratch database, '
+            'the datasets are rolled back after each measure.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--orders',
+            dest='orders',
+            type='int',
+            action='append',
+            help='Orders of a dataset, can be repeated. Default: 10000, 100000 and 1000000',
+        ),
+        make_option(
+            '--country',
+            dest="country",
+            default='AR',
+            help='Country of the events: AR or BR',
+        ),
+        make_option(
+            '--date',
+            dest='today_date',
+            type='string',
+            default='2020-04-01',
+            help='Generation date, the orders are in the previous month: YYYY-MM-DD format',
+        ),
+        make_option(
+            '--output',
+            dest='output',
+            default=os.path.join(settings.BASE_DIR, 'generation_benchmark.json'),
+            help='JSON file where the results are appended',
+        ),
+        make_option(
+            '--billing_jobs',
+            dest='billing_jobs',
+            type='int',
+            default=1000,
+            help='Jobs sent to a local billing stub, with a new client per job and with a reused client',
+        ),
+    )
+
+    def handle(self, **options):
+        if options['country'] not in settings.EVENTBRITE_TAX_INFORMATION:
+            raise CommandError('The country provided is not configured (settings.EVENTBRITE_TAX_INFORMATION)')
+
+        previous = self.load_runs(options['output'])
+        results = []
+        for orders in options['orders'] or [10000, 100000, 1000000]:
+            benchmark = GenerationBenchmark(orders, country=options['country'], today_date=options['today_date'])
+            with transaction.atomic():
+                benchmark.build_dataset()
+                result = benchmark.measure()
+                transaction.set_rollback(True)
+            results.append(result)
+            self.stdout.write(self.format_result(result, previous))
+
+        stub = BillingStub()
+        try:
+            billing = stub.measure(options['billing_jobs'])
+        finally:
+            stub.close()
+        self.stdout.write(self.format_billing(billing))
+
+        previous.append({
+            'date': datetime.now().isoformat(),
+            'country': options['country'],
+            'results': results,
+            'billing': billing,
+        })
+        with open(options['output'], 'w') as output:
+            json.dump({'runs': previous}, output, indent=2, sort_keys=True)
+
+    def load_runs(self, path):
+        if not os.path.exists(path):
+            return []
+        with open(path) as output:
+            return json.load(output)['runs']
+
+    def format_result(self, result, previous):
+        """
+            Times and peak memory of the result, next to the ratio against the last run of the same size
+        """
+        last = None
+        for run in previous:
+            for previous_result in run['results']:
+                if previous_result['orders'] == result['orders']:
+                    last = previous_result
+        lines = ['Orders: {orders}, events: {events}, tax receipts: {tax_receipts}'.format(**result)]
+        for stage in ('query_time', 'payload_time', 'iteration_time', 'end_to_end_time'):
+            line = '  {}: {:.3f}s'.format(stage, result[stage])
+            if last and last[stage]:
+                line += ' (x{:.2f} the last run)'.format(result[stage] / last[stage])
+            lines.append(line)
+        for stage in ('rows_memory', 'dict_rows_memory', 'end_to_end_memory'):
+            line = '  {}: {:.1f}MiB'.format(stage, result[stage])
+            if last and last.get(stage):
+                line += ' (x{:.2f} the last run)'.format(result[stage] / last[stage])
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def format_billing(self, billing):
+        """
+            Seconds per billing job with a new client and with a reused one
+        """
+        return '\n'.join([
+            'Billing stub jobs: {billing_jobs}'.format(**billing),
+            '  new client per job: {:.6f}s'.format(billing['billing_new_client_time']),
+            '  reused client: {:.6f}s (saves {:.6f}s per job)'.format(
+                billing['billing_reused_client_time'],
+                billing['billing_new_client_time'] - billing['billing_reused_client_time'],
+            ),
+        ])
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
 from optparse import make_option
+from invoicing_app.dry_run_sink import read_ndjson
 from invoicing_app.management.commands.generate_tax_receipts_new import Command as CommandOld
 from invoicing_app.tax_receipt_generator import (
     CountryNotConfiguredException,
@@ -33,6 +34,11 @@ class Command(BaseCommand):
             default=False,
             help='Enable logger in console',
         ),
+        make_option(
+            '--output',
+            dest='output',
+            help='Stream the results of the new script to this newline delimited JSON file instead of memory',
+        ),
     )
 
     def handle(self, *args, **options):
@@ -49,13 +55,19 @@ class Command(BaseCommand):
             'no_color': False,
             'country': 'AR',
             'logging': options['logging'],
-            'compare': True
+            'compare': True,
+            'output': options.get('output'),
         }
 
         self.new_results = self.run_new(options_to_commands)
         self.old_results = self.run_old(options_to_commands)
 
-        if self.new_results == self.old_results:
+        if options_to_commands['output']:
+            same_results = self.compare_output(options_to_commands['output'], self.old_results)
+        else:
+            same_results = self.new_results == self.old_results
+
+        if same_results:
             print('BOTHS SCRIPTS THROWS THE SAME RESULTS')
         else:
             print('THERE ARE DIFFERENCES BETWEEN THE RESULTS')
@@ -63,7 +75,8 @@ class Command(BaseCommand):
     def run_new(self, options_to_commands):
         tax_generator = TaxReceiptGenerator(
             dry_run=options_to_commands['dry_run'],
-            do_logging=options_to_commands['logging']
+            do_logging=options_to_commands['logging'],
+            dry_run_output=options_to_commands['output'],
         )
         try:
             request = TaxReceiptGeneratorRequest(
@@ -89,3 +102,16 @@ class Command(BaseCommand):
         my_command = CommandOld()
         my_command.handle(**options_to_commands)
         return my_command.output_dict
+
+    def compare_output(self, path, old_results):
+        """
+            Compare the results written to path one line at a time, so only the old
+            results are kept in memory. An event can be written more than once, the
+            distinct events are counted.
+        """
+        compared = set()
+        for event_id, payload in read_ndjson(path):
+            if old_results.get(event_id) != payload:
+                return False
+            compared.add(event_id)
+        return len(compared) == len(old_results)
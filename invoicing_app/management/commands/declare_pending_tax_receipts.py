@@ -1,8 +1,15 @@
 from __future__ import absolute_import
 
 from datetime import datetime as dt
+import json
 import logging
 from optparse import make_option
+import os
+import Queue
+import random
+import threading
+from time import sleep
+from timeit import default_timer
 
 from dateutil.relativedelta import relativedelta
 from django.db import close_old_connections
@@ -12,6 +19,10 @@ from django.db.models import (
     Sum,
 )
 
+from invoicing_app.batch_sizer import AdaptiveBatchSizer
+from invoicing_app.checkpoint import CheckpointStore, CheckpointTracker
+from invoicing_app.token_cache import TokenCache, is_auth_error
+
 try:
     # Local
     from invoicing import settings
@@ -24,7 +35,6 @@ except Exception:
     from django.conf import settings
     from common.management.base import BaseCommand
     from django.core.management.base import CommandError
-    from ebutils.collections import chunks
     from permissions.constants.permissions import PERMISSION_USER_BILLING_CHARGE_SCHEDULES_READ
     from service import control
     from billing_service.common.auth import get_cron_auth_token
@@ -33,6 +43,7 @@ except Exception:
     from billing_service.models.tax_receipts import TaxReceipt
 
 DATE_FORMAT = "%Y-%m-%d"
+JOURNAL = "declare"
 
 
 class Command(BaseCommand):
@@ -54,6 +65,17 @@ class Command(BaseCommand):
 
         use --dry_run to test the command but don't update any DB or call any service
 
+        the ids that billing rejected are written to --failed_file, to declare
+        only them again:
+        ./manage declare_pending_tax_receipts --retry_failed
+
+        when billing can't be reached the run stops, the batches not accepted are
+        declared by the next run
+
+        the batches accepted by billing are kept in a journal, to continue a run
+        that died with the same arguments:
+        ./manage declare_pending_tax_receipts --currency=BRL --resume
+
     """
 
     help = "Declara pending tax receipts"
@@ -92,6 +114,52 @@ class Command(BaseCommand):
             help="If set, nothing will be written to DB tables."
         ),
         make_option("--logging", action="store_true", dest="logging", default=False, help="Enable logger in console"),
+        make_option(
+            "--after_id",
+            dest="after_id",
+            type="int",
+            help="Only declare tax receipts with a greater id, to resume a previous run",
+        ),
+        make_option(
+            "--resume",
+            action="store_true",
+            dest="resume",
+            default=False,
+            help="Continue after the batches accepted by the previous run with the same arguments",
+        ),
+        make_option(
+            "--workers",
+            dest="workers",
+            type="int",
+            default=1,
+            help="Number of batches declared concurrently",
+        ),
+        make_option(
+            "--adaptive_batch",
+            action="store_true",
+            dest="adaptive_batch",
+            default=False,
+            help="Grow or shrink the batch size following the latency and errors of billing",
+        ),
+        make_option(
+            "--attempts",
+            dest="attempts",
+            type="int",
+            help="Attempts of each batch before it is split to find the failing ids",
+        ),
+        make_option(
+            "--failed_file",
+            dest="failed_file",
+            type="string",
+            help="File where the ids that could not be declared are written",
+        ),
+        make_option(
+            "--retry_failed",
+            action="store_true",
+            dest="retry_failed",
+            default=False,
+            help="Only declare the ids of --failed_file",
+        ),
     )
 
     def __init__(self, *args, **kwargs):
@@ -108,11 +176,39 @@ class Command(BaseCommand):
         self.event_id = None
         self.user_id = None
         self.mail_report = DeclarationProccessMailReport()
+        self.token_cache = TokenCache(self._fetch_auth_token, ttl=settings.BILLING_TOKEN_TTL)
+        self.workers = 1
+        self.after_id = None
+        self.tracker = CheckpointTracker()
+        self.resume = False
+        self.journal = CheckpointStore(settings.TAX_RECEIPTS_CHECKPOINT_FILE)
+        self.journal_key = None
+        self.accepted_batches = []
+        self._journal_lock = threading.Lock()
+        self.declared = 0
+        self.failed = 0
+        self.failed_batches = 0
+        self.attempts = settings.TAX_RECEIPTS_DECLARE_ATTEMPTS
+        self.backoff = settings.TAX_RECEIPTS_DECLARE_BACKOFF
+        self.failed_file = settings.TAX_RECEIPTS_DECLARE_FAILED_FILE
+        self.retry_failed = False
+        self.failed_output = self.failed_file
+        self.adaptive_batch = False
+        self.batch_sizer = None
+        self._results_lock = threading.Lock()
+        self.billing_error = None
 
         super(Command, self).__init__(*args, **kwargs)
 
     def handle(self, **options):
         self.dry_run = options["dry_run"]
+        self.workers = options.get("workers") or 1
+        self.after_id = options.get("after_id")
+        self.resume = options.get("resume", False)
+        self.attempts = options.get("attempts") or self.attempts
+        self.failed_file = options.get("failed_file") or self.failed_file
+        self.retry_failed = options.get("retry_failed", False)
+        self.adaptive_batch = options.get("adaptive_batch", False)
 
         if options["month_range"]:
             self.month_range = relativedelta(months=int(options.get("month_range")))
@@ -187,31 +283,325 @@ class Command(BaseCommand):
             if self.end_date_period:
                 find_args["end_date_period__lte"] = self.end_date_period
 
-            tax_receipt_ids = TaxReceipt.objects.filter(**find_args).values_list("id", flat=True)
+            if self.retry_failed:
+                find_args["id__in"] = self.read_failed_ids()
+
+            if self.adaptive_batch:
+                self.batch_sizer = AdaptiveBatchSizer(
+                    settings.TAX_RECEIPTS_BATCH_TO_DECLARE,
+                    settings.TAX_RECEIPTS_BATCH_TO_DECLARE_MIN,
+                    settings.TAX_RECEIPTS_BATCH_TO_DECLARE_MAX,
+                    settings.TAX_RECEIPTS_DECLARE_TARGET_LATENCY,
+                )
 
+            self.failed_output = self.failed_file
             if not self.dry_run:
-                client = control.Client("billing")
+                if self.retry_failed:
+                    # The ids failing again go to a new file, it replaces the failed file only
+                    # once every id was retried so a crash doesn't lose the ids to retry
+                    self.failed_output = "{}.retry".format(self.failed_file)
+                    open(self.failed_output, "w").close()
+                if not self.retry_failed:
+                    self.start_journal()
+                batches = self.pending_batches(find_args)
+                if self.workers > 1:
+                    self.declare_concurrently(batches)
+                else:
+                    client = control.Client("billing")
+                    for tax_receipt_ids_batch in batches:
+                        self.declare_batch(client, tax_receipt_ids_batch)
+                self.save_journal(completed=True)
+                if self.retry_failed:
+                    os.rename(self.failed_output, self.failed_file)
 
-                for tax_receipt_ids_batch in chunks(tax_receipt_ids, settings.TAX_RECEIPTS_BATCH_TO_DECLARE):
-                    close_old_connections()
+        except Exception as e:
 
-                    job = client.new_job()
-                    job.control.auth = get_cron_auth_token(PERMISSION_USER_BILLING_CHARGE_SCHEDULES_READ)
+            message = "Error in declare_tax_receipts: details: {}, dry_run: {}".format(str(e), self.dry_run)
+            self.logger.error(message)
 
-                    job.declare_tax_receipts(
-                        tax_receipt_ids=[str(tax_receipt_id) for tax_receipt_id in tax_receipt_ids_batch]
+        self.logger.info(
+            "Tax receipts declared: {}, failed: {} in {} batches".format(
+                self.declared,
+                self.failed,
+                self.failed_batches,
+            )
+        )
+        if self.batch_sizer:
+            self.logger.info("Batch sizes used: min {}, max {}, last {}".format(
+                min(self.batch_sizer.sizes),
+                max(self.batch_sizer.sizes),
+                self.batch_sizer.size,
+            ))
+        if self.tracker.last_event_id is not None:
+            self.logger.info("Every batch up to id {} was sent, use --resume or --after_id to continue".format(
+                self.tracker.last_event_id
+            ))
+
+    def pending_batches(self, find_args):
+        """
+            Yield the pending ids in batches of get_batch_size() ids. Each batch
+            is a page of the ids greater than the last id of the previous one, so only
+            one batch is in memory and the order is stable between runs. The pages
+            are read while the batches are declared, the connection may be stale.
+        """
+        last_id = self.after_id
+        while True:
+            close_old_connections()
+            tax_receipts = TaxReceipt.objects.filter(**find_args)
+            if last_id is not None:
+                tax_receipts = tax_receipts.filter(id__gt=last_id)
+            tax_receipt_ids_batch = list(
+                tax_receipts.order_by("id").values_list("id", flat=True)[:self.get_batch_size()]
+            )
+            if not tax_receipt_ids_batch:
+                return
+            last_id = tax_receipt_ids_batch[-1]
+            tax_receipt_ids_batch = [
+                tax_receipt_id for tax_receipt_id in tax_receipt_ids_batch if not self.is_accepted(tax_receipt_id)
+            ]
+            if tax_receipt_ids_batch:
+                self.tracker.start(tax_receipt_ids_batch[-1])
+                yield tax_receipt_ids_batch
+
+    def get_batch_size(self):
+        if self.batch_sizer:
+            return self.batch_sizer.size
+        return settings.TAX_RECEIPTS_BATCH_TO_DECLARE
+
+    def declare_concurrently(self, batches):
+        """
+            Declare the batches from self.workers threads, each one with its own billing
+            client. The workers never query the DB, the batches are read by the calling
+            thread. At most two batches per worker wait to be sent.
+        """
+        pending = Queue.Queue(maxsize=self.workers * 2)
+
+        def work():
+            client = control.Client("billing")
+            while True:
+                tax_receipt_ids_batch = pending.get()
+                if tax_receipt_ids_batch is None:
+                    return
+                if self.billing_error is not None:
+                    # The queued batches are left unaccepted
+                    continue
+                try:
+                    self.declare_batch(client, tax_receipt_ids_batch)
+                except BillingUnavailableException as e:
+                    self.billing_error = e
+                except Exception as e:
+                    # Keep the worker alive, otherwise the queue fills up and the reading blocks
+                    message = "Error in declare_tax_receipts: batch {}-{}, details: {}, dry_run: {}".format(
+                        tax_receipt_ids_batch[0],
+                        tax_receipt_ids_batch[-1],
+                        str(e),
+                        self.dry_run,
                     )
-                    response = client.send_job(job)
-
-                    if response.is_error():
-                        raise Exception(
-                            u"Failed to declare tax receipts: {error}".format(error=response.pretty_error())
-                        )
+                    self.logger.error(message)
 
+        workers = [threading.Thread(target=work) for _ in range(self.workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            for tax_receipt_ids_batch in batches:
+                if self.billing_error is not None:
+                    break
+                pending.put(tax_receipt_ids_batch)
+        finally:
+            for worker in workers:
+                pending.put(None)
+            for worker in workers:
+                worker.join()
+        if self.billing_error is not None:
+            raise self.billing_error
+
+    def declare_batch(self, client, tax_receipt_ids_batch):
+        tax_receipt_ids = [str(tax_receipt_id) for tax_receipt_id in tax_receipt_ids_batch]
+        first_attempt = {}
+        failed = self.declare_or_split(client, tax_receipt_ids, first_attempt)
+        # Only the first attempt of the whole batch says how billing copes with its size. When
+        # splitting found some failing ids they are bad data, not load, and nothing is recorded.
+        if first_attempt and not 0 < failed < len(tax_receipt_ids):
+            self.record_batch(tax_receipt_ids, first_attempt["seconds"], first_attempt["error"])
+        with self._results_lock:
+            self.declared += len(tax_receipt_ids) - failed
+            self.failed += failed
+            if failed:
+                self.failed_batches += 1
+        # The ids that failed are in the failed file, the batch is done for a resume
+        self.accept_batch(tax_receipt_ids_batch[0], tax_receipt_ids_batch[-1])
+
+    def declare_or_split(self, client, tax_receipt_ids, first_attempt=None):
+        """
+            Declare the ids retrying the job. When billing keeps rejecting it the ids
+            are split to find the rejected ones, those are written to the failed file.
+            Returns how many ids failed. Raises BillingUnavailableException when the
+            job can't be sent, the batch is left unaccepted and nothing else is sent.
+        """
+        try:
+            self.send_with_retries(client, tax_receipt_ids, first_attempt)
+            return 0
+        except DeclarationRejectedException as e:
+            return self.split_rejected(client, tax_receipt_ids, e)
         except Exception as e:
-
-            message = "Error in declare_tax_receipts: details: {}, dry_run: {}".format(str(e), self.dry_run)
+            raise BillingUnavailableException(
+                "Billing is unavailable, batch of {} tax receipts not sent: {}".format(len(tax_receipt_ids), str(e))
+            )
+
+    def split_rejected(self, client, tax_receipt_ids, error):
+        """
+            Declare the halves of the ids billing rejected with error, and again the
+            halves of a rejected half until the rejected ids are found. When both
+            halves are rejected with the same error the ids are not the problem,
+            billing is, and BillingUnavailableException is raised.
+        """
+        if len(tax_receipt_ids) == 1:
+            message = "Error in declare_tax_receipts: tax receipt: {}, details: {}, dry_run: {}".format(
+                tax_receipt_ids[0],
+                str(error),
+                self.dry_run,
+            )
             self.logger.error(message)
+            self.write_failed_id(tax_receipt_ids[0], str(error))
+            return 1
+
+        middle = len(tax_receipt_ids) // 2
+        self.logger.warning("Splitting batch of {} tax receipts: {}".format(len(tax_receipt_ids), str(error)))
+        rejected = []
+        for half in (tax_receipt_ids[:middle], tax_receipt_ids[middle:]):
+            try:
+                self.send_with_retries(client, half)
+            except DeclarationRejectedException as e:
+                rejected.append((half, e))
+            except Exception as e:
+                raise BillingUnavailableException(
+                    "Billing is unavailable, batch of {} tax receipts not sent: {}".format(len(half), str(e))
+                )
+        if len(rejected) == 2 and all(str(e) == str(error) for half, e in rejected):
+            raise BillingUnavailableException(
+                "Billing rejects every part of a batch of {} tax receipts: {}".format(len(tax_receipt_ids), str(error))
+            )
+        return sum(self.split_rejected(client, half, e) for half, e in rejected)
+
+    def send_with_retries(self, client, tax_receipt_ids, first_attempt=None):
+        """
+            first_attempt, when given, gets the seconds and error of the first job.
+        """
+        for attempt in range(self.attempts):
+            started = default_timer()
+            try:
+                self.send_declare_job(client, tax_receipt_ids)
+            except Exception:
+                if attempt == 0 and first_attempt is not None:
+                    first_attempt.update(seconds=default_timer() - started, error=True)
+                if attempt == self.attempts - 1:
+                    raise
+                # Exponential backoff with full jitter so the workers don't retry together
+                sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            else:
+                if attempt == 0 and first_attempt is not None:
+                    first_attempt.update(seconds=default_timer() - started, error=False)
+                return
+
+    def send_declare_job(self, client, tax_receipt_ids):
+        job = client.new_job()
+        job.control.auth = self.token_cache.get_token(PERMISSION_USER_BILLING_CHARGE_SCHEDULES_READ)
+
+        job.declare_tax_receipts(tax_receipt_ids=tax_receipt_ids)
+        response = client.send_job(job)
+
+        if response.is_error():
+            if is_auth_error(response):
+                # The retries get a new token
+                self.token_cache.invalidate(PERMISSION_USER_BILLING_CHARGE_SCHEDULES_READ)
+            raise DeclarationRejectedException(
+                u"Failed to declare tax receipts: {error}".format(error=response.pretty_error())
+            )
+
+    def record_batch(self, tax_receipt_ids, seconds, error):
+        if not self.batch_sizer:
+            return
+        size = self.batch_sizer.record(len(tax_receipt_ids), seconds, error)
+        if size is not None:
+            self.logger.info("Declaration batch size changed to {} after {} ids in {:.2f}s{}".format(
+                size,
+                len(tax_receipt_ids),
+                seconds,
+                " with error" if error else "",
+            ))
+
+    def write_failed_id(self, tax_receipt_id, error):
+        line = json.dumps({"tax_receipt_id": tax_receipt_id, "error": error}, sort_keys=True)
+        with self._results_lock:
+            with open(self.failed_output, "a") as failed_file:
+                failed_file.write(line + "\n")
+
+    def get_journal_key(self):
+        return (
+            JOURNAL,
+            self.currency or "",
+            self.start_date_period.strftime(DATE_FORMAT) if self.start_date_period else "",
+            self.end_date_period.strftime(DATE_FORMAT) if self.end_date_period else "",
+            self.event_id or "",
+            self.user_id or "",
+        )
+
+    def start_journal(self):
+        """
+            With --resume the scan starts after the last id of the previous run and
+            skips the batches it got accepted after that id (sent out of order by
+            the workers). Without it the journal of these arguments starts again.
+        """
+        self.journal_key = self.get_journal_key()
+        if not self.resume:
+            return
+        entry = self.journal.get(*self.journal_key)
+        if not entry:
+            return
+        if entry["last_id"] is not None and (self.after_id is None or entry["last_id"] > self.after_id):
+            self.after_id = entry["last_id"]
+        self.accepted_batches = [tuple(batch) for batch in entry["batches"]]
+        self.logger.info("Resuming after id {} and {} accepted batches".format(
+            self.after_id,
+            len(self.accepted_batches),
+        ))
+
+    def is_accepted(self, tax_receipt_id):
+        return any(first <= tax_receipt_id <= last for first, last in self.accepted_batches)
+
+    def accept_batch(self, first_id, last_id):
+        with self._journal_lock:
+            self.tracker.finish(last_id)
+            self.accepted_batches.append((first_id, last_id))
+            self.save_journal()
+
+    def save_journal(self, completed=False):
+        """
+            Store the last id of the accepted prefix and the batches accepted after
+            it, so the journal stays small however many batches the run sends.
+        """
+        if self.journal_key is None:
+            return
+        last_id = self.tracker.last_event_id
+        if last_id is None:
+            last_id = self.after_id
+        if last_id is not None:
+            self.accepted_batches = [batch for batch in self.accepted_batches if batch[1] > last_id]
+        self.journal.set(
+            {"last_id": last_id, "batches": sorted(self.accepted_batches), "completed": completed},
+            *self.journal_key
+        )
+
+    def read_failed_ids(self):
+        if not os.path.exists(self.failed_file):
+            return []
+        with open(self.failed_file) as failed_file:
+            return sorted(set(
+                int(json.loads(line)["tax_receipt_id"]) for line in failed_file if line.strip()
+            ))
+
+    def _fetch_auth_token(self, permission):
+        return get_cron_auth_token(permission)
 
     def enable_logging(self):
         console = logging.StreamHandler()
@@ -219,3 +609,15 @@ class Command(BaseCommand):
         formatter = logging.Formatter("%(name)-12s: %(levelname)-8s %(message)s")
         console.setFormatter(formatter)
         self.logger.addHandler(console)
+
+
+class DeclarationRejectedException(Exception):
+    """
+        Billing answered the declaration job with an error.
+    """
+
+
+class BillingUnavailableException(Exception):
+    """
+        The declaration job could not be sent or billing rejects any part of it.
+    """
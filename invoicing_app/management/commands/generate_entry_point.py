@@ -7,10 +7,12 @@ from optparse import make_option
 from invoicing_app.tax_receipt_generator import (
     CountryNotConfiguredException,
     IncorrectFormatDateException,
+    InvalidShardException,
     NoCountryProvidedException,
     TaxReceiptGenerator,
     TaxReceiptGeneratorRequest,
-    UserAndEventProvidedException
+    UserAndEventProvidedException,
+    run_shards,
 )
 
 
@@ -54,22 +56,115 @@ class Command(BaseCommand):
             '--country',
             dest="country",
             default=False,
-            help='specific country to process (like AR or BR)',
+            help='specific country to process (like AR or BR), several separated by commas share a single scan',
+        ),
+        make_option(
+            '--stream',
+            action="store_true",
+            dest="stream_results",
+            default=False,
+            help='Stream the query results from a server side cursor instead of loading them all in memory',
+        ),
+        make_option(
+            '--single_scan',
+            action="store_true",
+            dest="single_scan",
+            default=False,
+            help='Generate no series and child events with a single query',
+        ),
+        make_option(
+            '--workers',
+            dest='workers',
+            type='int',
+            default=1,
+            help='Number of concurrent billing dispatches',
+        ),
+        make_option(
+            '--resume',
+            action="store_true",
+            dest="resume",
+            default=False,
+            help='Continue from the last event processed by a previous run of the same country and period',
+        ),
+        make_option(
+            '--incremental',
+            action="store_true",
+            dest="incremental",
+            default=False,
+            help='Only generate the events with orders changed since the last run without errors',
+        ),
+        make_option(
+            '--use_rollup',
+            action="store_true",
+            dest="use_rollup",
+            default=False,
+            help='Aggregate from the daily order rollup (see update_order_rollup) instead of Orders',
+        ),
+        make_option(
+            '--columnar',
+            action="store_true",
+            dest="columnar",
+            default=False,
+            help='Sum the amounts in cents in the query and compute each chunk of results with numpy arrays',
+        ),
+        make_option(
+            '--max_in_flight',
+            dest='max_in_flight',
+            type='int',
+            default=0,
+            help='Send up to N billing batches in the background while the results are read',
+        ),
+        make_option(
+            '--log_every',
+            dest='log_every',
+            type='int',
+            default=1,
+            help='Log one of every N processed events, 0 disables the per event lines',
+        ),
+        make_option(
+            '--dry_run_output',
+            dest='dry_run_output',
+            help='With --dry_run, write the payloads to this newline delimited JSON file (gzip if it ends with .gz)',
+        ),
+        make_option(
+            '--shards',
+            dest='shards',
+            type='int',
+            default=1,
+            help='Split the events in N shards by event id. Without --shard_index every shard runs in its own process',
+        ),
+        make_option(
+            '--shard_index',
+            dest='shard_index',
+            type='int',
+            help='Only process this shard (0 to N - 1)',
         ),
     )
 
     def handle(self, **options):
 
-        tax_generator = TaxReceiptGenerator(
-            dry_run=options['dry_run'],
-            do_logging=options['logging']
-        )
+        generator_kwargs = {
+            'dry_run': options['dry_run'],
+            'do_logging': options['logging'],
+            'stream_results': options['stream_results'],
+            'single_scan': options['single_scan'],
+            'workers': options['workers'],
+            'resume': options['resume'],
+            'incremental': options['incremental'],
+            'use_rollup': options['use_rollup'],
+            'columnar': options['columnar'],
+            'max_in_flight': options['max_in_flight'],
+            'log_every': options['log_every'],
+            'dry_run_output': options['dry_run_output'],
+        }
         try:
             request = TaxReceiptGeneratorRequest(
                 event_id=options['event_id'],
                 user_id=options['user_id'],
                 country=options['country'],
                 today_date=options.get('today_date'),
+                shards=options['shards'],
+                shard_index=options['shard_index'],
             )
         except CountryNotConfiguredException as e:
             raise CommandError(e.message)
@@ -79,5 +174,10 @@ class Command(BaseCommand):
             raise CommandError(e.message)
         except IncorrectFormatDateException as e:
             raise CommandError(e.message)
+        except InvalidShardException as e:
+            raise CommandError(e.message)
 
-        tax_generator.run(request)
+        if request.shards > 1 and request.shard_index is None:
+            run_shards(request, generator_kwargs)
+        else:
+            TaxReceiptGenerator(**generator_kwargs).run(request)
@@ -0,0 +1,40 @@
+from django.core.management.base import (
+    BaseCommand,
+    CommandError
+)
+from optparse import make_option
+
+from invoicing import settings
+from invoicing_app.order_rollup import OrderRollupUpdater
+
+
+class Command(BaseCommand):
+    help = ('Update the daily order rollup used by generate_entry_point --use_rollup')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--country',
+            dest="country",
+            default=False,
+            help='Country of the events to update: AR or BR',
+        ),
+        make_option(
+            '--dry_run',
+            action="store_true",
+            dest='dry_run',
+            default=False,
+            help='If set, nothing will be written to DB tables.',
+        ),
+    )
+
+    def handle(self, **options):
+        if not options['country']:
+            raise CommandError('No country provided. It provides: command --country="EX"')
+        if options['country'] not in settings.EVENTBRITE_TAX_INFORMATION:
+            raise CommandError('The country provided is not configured (settings.EVENTBRITE_TAX_INFORMATION)')
+
+        updater = OrderRollupUpdater(options['country'], dry_run=options['dry_run'])
+        updater.update()
+        self.stdout.write(
+            'Events updated: {}, rollup rows: {}'.format(updater.events_updated, updater.rows_created)
+        )
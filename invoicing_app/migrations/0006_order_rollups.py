@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoicing_app', '0005_generation_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('country', models.CharField(max_length=2)),
+                ('pp_day', models.DateField()),
+                ('changed_day', models.DateField()),
+                ('orders_count', models.IntegerField(default=0)),
+                ('gross', models.DecimalField(default=0, max_digits=15, decimal_places=2)),
+                ('mg_fee', models.DecimalField(default=0, max_digits=15, decimal_places=2)),
+                ('eb_tax', models.DecimalField(null=True, max_digits=15, decimal_places=2)),
+                ('event', models.ForeignKey(db_column='event', on_delete=django.db.models.deletion.DO_NOTHING, to='invoicing_app.Event')),
+            ],
+            options={
+                'db_table': 'Order_Rollups',
+                'managed': True,
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='orderrollup',
+            unique_together=set([('country', 'event', 'pp_day', 'changed_day')]),
+        ),
+    ]
@@ -49,6 +49,11 @@ class Order(models.Model):
     class Meta:
         managed = True
         db_table = 'Orders'
+        # Predicate of the tax receipts generation query followed by the summed
+        # columns, so MySQL answers it from the index without reading the rows
+        index_together = [
+            ['status', 'changed', 'pp_date', 'event', 'mg_fee', 'eb_tax', 'gross'],
+        ]
 
     status = models.IntegerField(
         choices=STATUS_CHOICES,
@@ -249,4 +254,47 @@ class Users_Tax_Regimes(models.Model):
     user_id = models.IntegerField(null=True, blank=True)
 
     class Meta:
-        db_table = "Users_Tax_Regimes"
\ No newline at end of file
+        db_table = "Users_Tax_Regimes"
+
+
+class OrderRollup(models.Model):
+    """
+        Placed orders with mg_fee of an event, summed per day of pp_date and of
+        changed in the timezone of the country. Maintained by update_order_rollup.
+    """
+    class Meta:
+        managed = True
+        db_table = 'Order_Rollups'
+        unique_together = (
+            ('country', 'event', 'pp_day', 'changed_day'),
+        )
+
+    country = models.CharField(
+        max_length=2,
+    )
+    event = models.ForeignKey(
+        'Event',
+        db_column='event',
+        db_index=True,
+        on_delete=models.DO_NOTHING,
+    )
+    pp_day = models.DateField()
+    changed_day = models.DateField()
+    orders_count = models.IntegerField(
+        default=0,
+    )
+    gross = models.DecimalField(
+        default=0,
+        decimal_places=2,
+        max_digits=15,
+    )
+    mg_fee = models.DecimalField(
+        default=0,
+        decimal_places=2,
+        max_digits=15,
+    )
+    eb_tax = models.DecimalField(
+        null=True,
+        decimal_places=2,
+        max_digits=15,
+    )
@@ -0,0 +1,113 @@
+from collections import defaultdict
+import logging
+
+from decimal import Decimal
+
+import pytz
+
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from invoicing import settings
+from invoicing_app.checkpoint import CheckpointStore
+from invoicing_app.models import (
+    ORDER_PLACED,
+    Event,
+    Order,
+    OrderRollup,
+    PaymentOptions,
+)
+
+ROLLUP = 'rollup'
+EVENTS_PER_TRANSACTION = 500
+
+
+class OrderRollupUpdater(object):
+    """
+        Keep the Order_Rollups rows of a country up to date. Only the events with
+        orders changed since the previous update are summed again, the first
+        update builds every event of the country.
+    """
+
+    def __init__(self, country, dry_run=False):
+        self.country = country
+        self.dry_run = dry_run
+        self.timezone = pytz.timezone(pytz.country_timezones(country)[0])
+        self.checkpoint_store = CheckpointStore(settings.TAX_RECEIPTS_CHECKPOINT_FILE)
+        self.logger = logging.getLogger('financial_transactions')
+        self.events_updated = 0
+        self.rows_created = 0
+
+    def update(self):
+        watermark = self.get_watermark()
+        # Read before summing so orders changed meanwhile are summed next time
+        new_watermark = Order.objects.aggregate(changed=Max('changed'))['changed']
+        event_ids = self.get_events_to_update(watermark)
+        self.logger.info("Updating the rollup of {} events of {}".format(len(event_ids), self.country))
+
+        for start in range(0, len(event_ids), EVENTS_PER_TRANSACTION):
+            self.update_events(event_ids[start:start + EVENTS_PER_TRANSACTION])
+
+        if not self.dry_run and new_watermark is not None:
+            self.checkpoint_store.set({'changed': new_watermark.isoformat()}, ROLLUP, self.country)
+
+    def get_watermark(self):
+        stored = self.checkpoint_store.get(ROLLUP, self.country)
+        return stored['changed'] if stored else None
+
+    def get_events_to_update(self, watermark):
+        country_events = PaymentOptions.objects.filter(
+            epp_country=self.country
+        ).values_list('event', flat=True)
+        events = Event.objects.filter(Q(id__in=country_events) | Q(event_parent__in=country_events))
+        if watermark:
+            events = events.filter(id__in=Order.objects.filter(changed__gt=watermark).values('event'))
+        return sorted(events.values_list('id', flat=True))
+
+    def update_events(self, event_ids):
+        rollups = self.build_rollups(event_ids)
+        self.events_updated += len(event_ids)
+        self.rows_created += len(rollups)
+        if self.dry_run:
+            return
+        with transaction.atomic():
+            OrderRollup.objects.filter(country=self.country, event__in=event_ids).delete()
+            OrderRollup.objects.bulk_create(rollups)
+
+    def build_rollups(self, event_ids):
+        orders = Order.objects.filter(
+            event__in=event_ids,
+            status=ORDER_PLACED,
+            mg_fee__gt=Decimal('0.00'),
+            pp_date__isnull=False,
+        ).values_list('event', 'pp_date', 'changed', 'gross', 'mg_fee', 'eb_tax')
+
+        totals = defaultdict(lambda: [0, Decimal('0.00'), Decimal('0.00'), None])
+        for event_id, pp_date, changed, gross, mg_fee, eb_tax in orders.iterator():
+            total = totals[(event_id, self.local_day(pp_date), self.local_day(changed))]
+            total[0] += 1
+            total[1] += gross
+            total[2] += mg_fee
+            # EB-28811: some eb_tax in DB has Null, kept as in SUM(`eb_tax`)
+            if eb_tax is not None:
+                total[3] = (total[3] or Decimal('0.00')) + eb_tax
+
+        return [
+            OrderRollup(
+                country=self.country,
+                event_id=event_id,
+                pp_day=pp_day,
+                changed_day=changed_day,
+                orders_count=orders_count,
+                gross=gross,
+                mg_fee=mg_fee,
+                eb_tax=eb_tax,
+            )
+            for (event_id, pp_day, changed_day), (orders_count, gross, mg_fee, eb_tax) in sorted(totals.items())
+        ]
+
+    def local_day(self, date):
+        if timezone.is_naive(date):
+            date = timezone.make_aware(date, timezone.get_default_timezone())
+        return date.astimezone(self.timezone).date()
@@ -0,0 +1,77 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from timeit import default_timer
+import threading
+
+
+class RunMetrics(object):
+    """
+        Timers, counters and latency histograms of a generation run. Safe to use
+        from the dispatch threads.
+    """
+    # Upper bounds in seconds of the histogram buckets
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = defaultdict(lambda: {'seconds': 0.0, 'calls': 0})
+        self.counters = defaultdict(int)
+        self.histograms = {}
+
+    @contextmanager
+    def timer(self, name):
+        started = default_timer()
+        try:
+            yield
+        finally:
+            elapsed = default_timer() - started
+            with self._lock:
+                self.timers[name]['seconds'] += elapsed
+                self.timers[name]['calls'] += 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {
+                    'count': 0,
+                    'seconds': 0.0,
+                    'max': 0.0,
+                    'buckets': [0] * (len(self.BUCKETS) + 1),
+                }
+            histogram['count'] += 1
+            histogram['seconds'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+            for index, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                index = len(self.BUCKETS)
+            histogram['buckets'][index] += 1
+
+    def rows_per_second(self, rows_counter, timer_names):
+        seconds = sum(self.timers[name]['seconds'] for name in timer_names if name in self.timers)
+        if not seconds:
+            return None
+        return self.counters[rows_counter] / seconds
+
+    def summary(self):
+        with self._lock:
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                labels = ['<={}s'.format(bound) for bound in self.BUCKETS] + ['>{}s'.format(self.BUCKETS[-1])]
+                histograms[name] = {
+                    'count': histogram['count'],
+                    'mean': histogram['seconds'] / histogram['count'],
+                    'max': histogram['max'],
+                    'buckets': dict(zip(labels, histogram['buckets'])),
+                }
+            return {
+                'timers': dict((name, dict(timer)) for name, timer in self.timers.items()),
+                'counters': dict(self.counters),
+                'histograms': histograms,
+            }
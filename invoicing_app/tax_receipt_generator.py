@@ -1,4 +1,14 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import copy
+from itertools import count, islice
+import json
 import logging
+import multiprocessing
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer
 
 from invoicing import settings
 
@@ -6,37 +16,175 @@ from datetime import datetime as dt
 from dateutil.relativedelta import relativedelta
 import pytz
 
-from django.db import connection
+from django.db import connection, connections
 
 from decimal import Decimal
 
 from invoicing_app.slack_module import SlackConnection
 from invoicing_app.mail_report_module import GenerationProccessMailReport
+from invoicing_app.checkpoint import CheckpointStore, CheckpointTracker
+from invoicing_app.columnar import chunk_amounts, numpy
+from invoicing_app.dry_run_sink import NdjsonSink, shard_path
+from invoicing_app.run_metrics import RunMetrics
+from invoicing_app.token_cache import TokenCache, is_auth_error
 
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 NAME_LOGGING = 'generate_tax_receipts'
 SLACK_TOKEN = ''
 SLACK_CHANNEL = '#invoicing_arg_brl'
+FETCH_SIZE = 1000
+# Seconds to wait for the results of a shard once its process exited
+SHARD_RESULT_TIMEOUT = 5
+PHASE_NO_SERIES = 'no_series'
+PHASE_CHILD = 'child'
+PHASE_ALL = 'all'
+WATERMARK = 'watermark'
+
+# Join of Events with the Payment_Options of each phase. In PHASE_ALL a child event
+# uses the payment options of its parent when they accept eventbrite in the country
+# of the run (PARENT_PAYMENT_OPTIONS_JOIN), and its own ones otherwise.
+PARENT_CHILD_MASKS = {
+    PHASE_NO_SERIES: '(`Events`.`id` = `Payment_Options`.`event`)',
+    PHASE_CHILD: '(`Events`.`event_parent` = `Payment_Options`.`event`)',
+    PHASE_ALL: '(`Payment_Options`.`event` = COALESCE(`Parent_Payment_Options`.`event`, `Events`.`id`))',
+}
+PAYMENT_OPTIONS_JOIN = 'INNER JOIN `Payment_Options` ON {parent_child_mask}'
+# Joined before Payment_Options in PHASE_ALL, both joins are lookups by the unique
+# event key of Payment_Options
+PARENT_PAYMENT_OPTIONS_JOIN = '''LEFT JOIN `Payment_Options` AS `Parent_Payment_Options` ON (
+                    `Parent_Payment_Options`.`event` = `Events`.`event_parent` AND
+                    `Parent_Payment_Options`.`accept_eventbrite` = 1 AND
+                    `Parent_Payment_Options`.`epp_country` = %(declarable_tax_receipt_countries_query)s
+                )
+                '''
+
+# Columns of TaxReceiptGenerator.query
+GenerationRow = namedtuple('GenerationRow', [
+    'event_id',
+    'user_id',
+    'event_parent',
+    'currency',
+    'epp_country',
+    'epp_name_on_account',
+    'epp_address1',
+    'epp_address2',
+    'epp_zip',
+    'epp_city',
+    'epp_state',
+    'epp_tax_identifier',
+    'payment_transactions_count',
+    'total_tax_amount',
+    'total_taxable_amount_with_tax_amount',
+    'base_amount',
+])
+
+# Amounts in cents summed by the queries for the columnar stage, added after
+# `base_amount`. The money columns have two decimals at most, so they are exact
+# integers and TRUNCATE keeps the int(amount * 100) of the rows computed one by one.
+CENTS_COLUMNS = ''',
+                CAST(TRUNCATE(SUM(`{table}`.`gross`) * 100, 0) AS SIGNED) AS `base_cents`,
+                CAST(TRUNCATE(SUM(`{table}`.`mg_fee`) * 100, 0) AS SIGNED) AS `total_taxable_with_tax_cents`,
+                CAST(TRUNCATE(COALESCE(SUM(`{table}`.`eb_tax`), 0) * 100, 0) AS SIGNED) AS `total_tax_cents`'''
+
+# Columns of the queries with CENTS_COLUMNS
+ColumnarGenerationRow = namedtuple(
+    'ColumnarGenerationRow',
+    GenerationRow._fields + ('base_cents', 'total_taxable_with_tax_cents', 'total_tax_cents')
+)
+
+
+def get_row_type(description):
+    """
+        Tuple type for the rows of a cursor, GenerationRow for the generation query
+        and ColumnarGenerationRow for the same query with CENTS_COLUMNS.
+    """
+    columns = tuple(str(col[0]) for col in description)
+    for row_type in (GenerationRow, ColumnarGenerationRow):
+        if columns == row_type._fields:
+            return row_type
+    return namedtuple('QueryRow', columns, rename=True)
+
+
+def configure_console_logger():
+    """
+        Add the console handler of the NAME_LOGGING logger only once, however many
+        generators are created.
+    """
+    logger = logging.getLogger(NAME_LOGGING)
+    if any(getattr(handler, 'generation_console', False) for handler in logger.handlers):
+        return logger
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(name)s | %(levelname)s | %(message)s')
+    ch.setFormatter(formatter)
+    ch.generation_console = True
+    logger.addHandler(ch)
+    return logger
+
 
 class TaxReceiptGenerator():
 
-    def __init__(self, dry_run, do_logging):
+    def __init__(
+            self,
+            dry_run,
+            do_logging,
+            stream_results=False,
+            single_scan=False,
+            workers=1,
+            resume=False,
+            incremental=False,
+            use_rollup=False,
+            columnar=False,
+            max_in_flight=0,
+            log_every=1,
+            dry_run_output=None
+    ):
         self.dry_run = dry_run
         self.do_logging = do_logging
+        self.stream_results = stream_results
+        self.single_scan = single_scan
+        self.workers = workers
+        self.resume = resume
+        self.incremental = incremental
+        self.use_rollup = use_rollup
+        self.columnar = columnar
+        self.max_in_flight = max_in_flight
+        self.log_every = log_every
+        self._event_logs = count()
+        self.dry_run_output = dry_run_output
+        self.dry_run_sink = None
+        self.notify = True
         self.logger = logging.getLogger('financial_transactions')
+        if self.columnar and numpy is None:
+            self.logger.warning("numpy is not installed, the amounts are computed row by row")
+            self.columnar = False
         self.conditional_mask = ''
         self.cont_tax_receipts = 0
         self.error_cont = 0
         self.output_dict = {}
+        self._counters_lock = threading.Lock()
+        self.batch_size = settings.TAX_RECEIPTS_BATCH_TO_GENERATE
+        self._batch = []
+        self._batch_lock = threading.Lock()
+        self.token_cache = TokenCache(self._fetch_billing_token, ttl=settings.BILLING_TOKEN_TTL)
+        self._billing_clients = None
+        self._billing_clients_count = 0
+        self._clients_lock = threading.Lock()
+        self._dispatch_pool = None
+        self._in_flight = None
+        self.checkpoint_store = CheckpointStore(settings.TAX_RECEIPTS_CHECKPOINT_FILE)
+        self.checkpoint_tracker = CheckpointTracker()
+        self.checkpoint_key = None
+        self.checkpoint_phase = None
+        self._payload_templates = {}
+        self.countries = []
+        self.country_windows = {}
+        self.metrics = RunMetrics()
+        self.run_summary = None
         self.slack_notification = SlackConnection(SLACK_TOKEN)
         self.mail_report = GenerationProccessMailReport()
-        logger = logging.getLogger(NAME_LOGGING)
-        logger.setLevel(logging.DEBUG)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(name)s | %(levelname)s | %(message)s')
-        ch.setFormatter(formatter)
-        logger.addHandler(ch)
+        configure_console_logger()
         self.query = '''
             SELECT
                 `Orders`.`event` as `event_id`,
@@ -71,7 +219,61 @@ class TaxReceiptGenerator():
             )
             GROUP BY
                 `event_id`
-            ORDER BY NULL
+            ORDER BY
+                `event_id`
+        '''
+        # Same rows as query, summed from the days of Order_Rollups in the period
+        self.rollup_query = '''
+            SELECT
+                `Order_Rollups`.`event` as `event_id`,
+                `Events`.`uid` as `user_id`,
+                `Events`.`event_parent` as `event_parent`,
+                `Events`.`currency` as `currency`,
+                `Payment_Options`.`epp_country` as `epp_country`,
+                `Payment_Options`.`epp_name_on_account` as `epp_name_on_account`,
+                `Payment_Options`.`epp_address1` as `epp_address1`,
+                `Payment_Options`.`epp_address2` as `epp_address2`,
+                `Payment_Options`.`epp_zip` as `epp_zip`,
+                `Payment_Options`.`epp_city` as `epp_city`,
+                `Payment_Options`.`epp_state` as `epp_state`,
+                `Payment_Options`.`epp_tax_identifier` as `epp_tax_identifier`,
+                CAST(SUM(`Order_Rollups`.`orders_count`) AS SIGNED) AS `payment_transactions_count`,
+                SUM(`Order_Rollups`.`eb_tax`) AS `total_tax_amount`,
+                SUM(`Order_Rollups`.`mg_fee`) AS `total_taxable_amount_with_tax_amount`,
+                SUM(`Order_Rollups`.`gross`) AS `base_amount`
+            FROM `Order_Rollups`
+                INNER JOIN `Events` ON (`Order_Rollups`.`event` = `Events`.`id` )
+                INNER JOIN `Payment_Options` ON {parent_child_mask}
+            WHERE (
+                `Order_Rollups`.`country` = %(declarable_tax_receipt_countries_query)s AND
+                `Order_Rollups`.`pp_day` >= %(start_day_query)s AND
+                `Order_Rollups`.`pp_day` < %(end_day_query)s AND
+                `Order_Rollups`.`changed_day` >= %(start_day_query)s AND
+                `Order_Rollups`.`changed_day` < %(end_day_query)s AND
+                `Payment_Options`.`accept_eventbrite` = 1 AND
+                `Payment_Options`.`epp_country` = %(declarable_tax_receipt_countries_query)s
+                {condition_mask}
+            )
+            GROUP BY
+                `event_id`
+            ORDER BY
+                `event_id`
+        '''
+        self.watermark_query = '''
+            SELECT
+                MAX(`Orders`.`changed`)
+            FROM `Orders`
+            WHERE (
+                `Orders`.`changed` >= %(localize_start_date_query)s AND
+                `Orders`.`changed` <= %(localize_end_date_query)s
+            )
+        '''
+        self.watermark_mask = '''
+                AND `Events`.`id` IN (
+                    SELECT `Orders`.`event`
+                    FROM `Orders`
+                    WHERE `Orders`.`changed` > %(watermark_query)s
+                )
         '''
 
     def run(self, request):
@@ -85,52 +287,134 @@ class TaxReceiptGenerator():
             user_id = request.user_id
             self.conditional_mask = 'AND `Events`.`uid` = {}'.format(user_id)
 
-        localize_start_date = self.localize_date(
-            request.country,
-            request.period_start
-        )
-        localize_end_date = self.localize_date(
-            request.country,
-            request.period_end
-        )
+        self.countries = request.countries
+        self.checkpoint_key = ('+'.join(request.countries), request.period_start.strftime('%Y-%m'))
+        # Runs of one event or user keep their progress apart from the full runs
+        if request.event_id:
+            self.checkpoint_key += ('event-{}'.format(request.event_id),)
+        elif request.user_id:
+            self.checkpoint_key += ('user-{}'.format(request.user_id),)
+        if request.shards > 1:
+            self.conditional_mask += ' AND MOD(`Events`.`id`, {}) = {}'.format(request.shards, request.shard_index)
+            self.checkpoint_key += ('shard-{}-of-{}'.format(request.shard_index, request.shards),)
+            # The shards run in their own processes, each one keeps its checkpoints in its own file
+            self.checkpoint_store = CheckpointStore(
+                shard_path(settings.TAX_RECEIPTS_CHECKPOINT_FILE, request.shard_index)
+            )
+            if self.dry_run_output:
+                self.dry_run_output = shard_path(self.dry_run_output, request.shard_index)
+
+        self.metrics = RunMetrics()
+        with self.metrics.timer('localize_dates'):
+            self.country_windows = {}
+            for country in request.countries:
+                self.country_windows[country] = (
+                    self.localize_date(country, request.period_start),
+                    self.localize_date(country, request.period_end),
+                )
+        # The scan covers the union of the windows of every country
+        localize_start_date = min(start for start, end in self.country_windows.values())
+        localize_end_date = max(end for start, end in self.country_windows.values())
 
         query_options = {
             'localize_end_date_query': localize_end_date,
             'localize_start_date_query': localize_start_date,
-            'declarable_tax_receipt_countries_query': request.country,
+            'declarable_tax_receipt_countries_query': request.countries[0],
             'status_query': 100,
         }
+        if len(request.countries) > 1:
+            for index, country in enumerate(request.countries):
+                query_options['country_{}_query'.format(index)] = country
+                query_options['country_{}_start_query'.format(index)] = self.country_windows[country][0]
+                query_options['country_{}_end_query'.format(index)] = self.country_windows[country][1]
 
-        if not self.dry_run:
-            self.slack_notification.post_message(
-                SLACK_CHANNEL,
-                '''
-                    The generation script has started.
-                    - Country: {country}
-                    - Start date: {start}
-                    - End date: {end}
-                '''.format(country=request.country, start=request.period_start, end=request.period_end)
-            )
+        if self.use_rollup:
+            query_options['start_day_query'] = request.period_start.date()
+            query_options['end_day_query'] = request.period_end.date()
+
+        self._payload_templates = {}
+
+        new_watermark = None
+        if self.incremental:
+            new_watermark = self.get_current_watermark(query_options)
+            watermark = self.get_watermark()
+            if watermark:
+                self.logger.info("Only events with orders changed after {}".format(watermark))
+                query_options['watermark_query'] = watermark
+                self.conditional_mask += self.watermark_mask
+
+        if not self.dry_run and self.notify:
+            with self.metrics.timer('notifications'):
+                self.notify_start(request)
         self.logger.info("Starting generate tax receipts")
         self.logger.info("Start date: {}".format(request.period_start))
         self.logger.info("End date: {}".format(request.period_end))
-        self.get_and_iterate_no_series_events(query_options)
-        self.get_and_iterate_child_events(query_options)
+        if self.dry_run and self.dry_run_output:
+            self.dry_run_sink = NdjsonSink(self.dry_run_output)
+        self.open_billing_clients()
+        self.start_dispatcher()
+        try:
+            if self.single_scan:
+                self.get_and_iterate_all_events(query_options)
+            else:
+                self.get_and_iterate_no_series_events(query_options)
+                self.get_and_iterate_child_events(query_options)
+        finally:
+            self.stop_dispatcher()
+            self.close_billing_clients()
+            if self.dry_run_sink:
+                self.dry_run_sink.close()
+        if self.incremental and self.error_cont == 0:
+            self.save_watermark(new_watermark)
         self.logger.info("Tax receipts generated: {}".format(self.cont_tax_receipts))
         self.logger.info("Errors: {}".format(self.error_cont))
         self.logger.info("End Generation new tax receipts")
         self.logger.info("Ending generate tax receipts")
-        if not self.dry_run:
-            self.slack_notification.post_message(
-                SLACK_CHANNEL,
-                '''
-                    The generation script has finished.
-                    - Tax receipts generated: {generated}
-                    - Errors: {errors}
-                '''.format(generated=self.cont_tax_receipts, errors=self.error_cont)
-            )
+        if not self.dry_run and self.notify:
+            with self.metrics.timer('notifications'):
+                self.notify_end(request)
+        self.run_summary = self.get_run_summary()
+        self.logger.info("Run metrics: {}".format(json.dumps(self.run_summary, sort_keys=True)))
+
+    def get_run_summary(self):
+        """
+            Seconds and calls of each stage (localize_dates, <phase>_query,
+            <phase>_iterate, billing, notifications), counters, histogram of the
+            latency of each event from its read to the answer of billing and rows
+            per second of the queries and iterations.
+        """
+        summary = self.metrics.summary()
+        summary['counters']['tax_receipts'] = self.cont_tax_receipts
+        summary['counters']['errors'] = self.error_cont
+        summary['rows_per_second'] = self.metrics.rows_per_second(
+            'rows',
+            [name for name in summary['timers'] if name.endswith('_query') or name.endswith('_iterate')]
+        )
+        return summary
+
+    def notify_start(self, request):
+        self.slack_notification.post_message(
+            SLACK_CHANNEL,
+            '''
+                The generation script has started.
+                - Country: {country}
+                - Start date: {start}
+                - End date: {end}
+            '''.format(country=', '.join(request.countries), start=request.period_start, end=request.period_end)
+        )
+
+    def notify_end(self, request):
+        self.slack_notification.post_message(
+            SLACK_CHANNEL,
+            '''
+                The generation script has finished.
+                - Tax receipts generated: {generated}
+                - Errors: {errors}
+            '''.format(generated=self.cont_tax_receipts, errors=self.error_cont)
+        )
+        for country in request.countries:
             self.mail_report.generation_send_email_report(
-                request.country,
+                country,
                 request.period_start,
                 request.period_end
             )
@@ -154,97 +438,309 @@ class TaxReceiptGenerator():
             )
 
     def get_and_iterate_no_series_events(self, query_options):
-        parent_mask = '(`Events`.`id` = `Payment_Options`.`event`)'
-        query = self.query.format(condition_mask=self.conditional_mask, parent_child_mask=parent_mask)
-        query_results = self.get_query_results(query_options, query)
-        self.iterate_querys_results(
-            query_results,
-            query_options['localize_start_date_query'],
-            query_options['localize_end_date_query'],
-        )
+        self.get_and_iterate_phase(PHASE_NO_SERIES, PARENT_CHILD_MASKS[PHASE_NO_SERIES], query_options)
 
     def get_and_iterate_child_events(self, query_options):
-        child_mask = '(`Events`.`event_parent` = `Payment_Options`.`event`)'
-        query = self.query.format(condition_mask=self.conditional_mask, parent_child_mask=child_mask)
-        query_results = self.get_query_results(query_options, query)
-        self.iterate_querys_results(
-            query_results,
-            query_options['localize_start_date_query'],
-            query_options['localize_end_date_query'],
+        self.get_and_iterate_phase(PHASE_CHILD, PARENT_CHILD_MASKS[PHASE_CHILD], query_options)
+
+    def get_and_iterate_all_events(self, query_options):
+        """
+            Cover no series and child events with a single scan of Orders, joining each
+            event with the payment options of its parent when the parent has accepting
+            ones, and with its own payment options otherwise.
+        """
+        self.get_and_iterate_phase(PHASE_ALL, PARENT_CHILD_MASKS[PHASE_ALL], query_options)
+
+    def get_and_iterate_phase(self, phase, parent_child_mask, query_options):
+        condition_mask = self.conditional_mask
+        checkpoint = self.get_checkpoint(phase)
+        self.checkpoint_tracker = CheckpointTracker()
+        if checkpoint:
+            if checkpoint['completed']:
+                self.logger.info("Skipping {} events, completed in a previous run".format(phase))
+                return
+            failed_event_ids = checkpoint.get('failed_event_ids') or []
+            self.logger.info("Resuming {} events after event {}, retrying {} failed events".format(
+                phase,
+                checkpoint['last_event_id'],
+                len(failed_event_ids)
+            ))
+            self.checkpoint_tracker = CheckpointTracker(checkpoint['last_event_id'], failed_event_ids)
+            condition_mask += ' AND {}'.format(self.resume_condition(checkpoint['last_event_id'], failed_event_ids))
+
+        query = self.rollup_query if self.use_rollup else self.query
+        if phase == PHASE_ALL:
+            query = self.join_parent_payment_options(query)
+        if len(self.countries) > 1:
+            query = self.route_countries(query)
+        if self.columnar:
+            query = self.add_cents_columns(query)
+        query = query.format(condition_mask=condition_mask, parent_child_mask=parent_child_mask)
+        # With stream_results the rows are fetched while iterating, within <phase>_iterate
+        with self.metrics.timer('{}_query'.format(phase)):
+            query_results = self.get_query_results(query_options, query)
+        self.checkpoint_phase = phase
+        with self.metrics.timer('{}_iterate'.format(phase)):
+            self.iterate_querys_results(
+                query_results,
+                query_options['localize_start_date_query'],
+                query_options['localize_end_date_query'],
+            )
+        self.save_checkpoint(completed=True)
+
+    def resume_condition(self, last_event_id, failed_event_ids):
+        """
+            Events after the last one of the previous run and the ones it failed.
+        """
+        conditions = []
+        if last_event_id is not None:
+            conditions.append('`Events`.`id` > {}'.format(int(last_event_id)))
+        if failed_event_ids:
+            conditions.append('`Events`.`id` IN ({})'.format(
+                ', '.join(str(int(event_id)) for event_id in failed_event_ids)
+            ))
+        if len(conditions) == 1:
+            return conditions[0]
+        return '({})'.format(' OR '.join(conditions)) if conditions else 'TRUE'
+
+    def join_parent_payment_options(self, query):
+        return query.replace(PAYMENT_OPTIONS_JOIN, PARENT_PAYMENT_OPTIONS_JOIN + PAYMENT_OPTIONS_JOIN)
+
+    def route_countries(self, query):
+        """
+            Filter the query by every country of the run, each one with its own
+            localized window. Rollup days are already local to their country. In
+            PHASE_ALL a child uses the payment options of its parent when they
+            accept eventbrite in any of the countries.
+        """
+        country_params = ['%(country_{}_query)s'.format(index) for index in range(len(self.countries))]
+        query = query.replace(
+            '`Parent_Payment_Options`.`epp_country` = %(declarable_tax_receipt_countries_query)s',
+            '`Parent_Payment_Options`.`epp_country` IN ({})'.format(', '.join(country_params))
+        )
+        if self.use_rollup:
+            query = query.replace(
+                '`Order_Rollups`.`country` = %(declarable_tax_receipt_countries_query)s',
+                '`Order_Rollups`.`country` = `Payment_Options`.`epp_country`'
+            )
+            return query.replace(
+                '`Payment_Options`.`epp_country` = %(declarable_tax_receipt_countries_query)s',
+                '`Payment_Options`.`epp_country` IN ({})'.format(', '.join(country_params))
+            )
+
+        windows = []
+        for index in range(len(self.countries)):
+            windows.append(
+                '''(
+                    `Payment_Options`.`epp_country` = %(country_{index}_query)s AND
+                    `Orders`.`pp_date` >= %(country_{index}_start_query)s AND
+                    `Orders`.`pp_date` <= %(country_{index}_end_query)s AND
+                    `Orders`.`changed` >= %(country_{index}_start_query)s AND
+                    `Orders`.`changed` <= %(country_{index}_end_query)s
+                )'''.format(index=index)
+            )
+        return query.replace(
+            '`Payment_Options`.`epp_country` = %(declarable_tax_receipt_countries_query)s',
+            '({})'.format(' OR '.join(windows))
+        )
+
+    def add_cents_columns(self, query):
+        """
+            Sum the amounts in cents in the query too, so the columnar stage reads
+            integers and never converts a Decimal.
+        """
+        table = 'Order_Rollups' if self.use_rollup else 'Orders'
+        base_amount = 'SUM(`{}`.`gross`) AS `base_amount`'.format(table)
+        return query.replace(base_amount, base_amount + CENTS_COLUMNS.format(table=table))
+
+    def get_checkpoint(self, phase):
+        if not self.resume or not self.checkpoint_key:
+            return None
+        return self.checkpoint_store.get(*(self.checkpoint_key + (phase,)))
+
+    def save_checkpoint(self, completed=False):
+        """
+            Store the last event id processed in the current phase and the events
+            that failed, retried by --resume. A phase with failed events is never
+            completed. Nothing is stored in dry runs. A checkpoint that can't be
+            stored is only logged, the events were already processed.
+        """
+        if self.dry_run or not self.checkpoint_key or not self.checkpoint_phase:
+            return
+        try:
+            self._save_checkpoint(completed)
+        except Exception as e:
+            self.logger.warning("The checkpoint of {} events was not stored: {}".format(self.checkpoint_phase, e))
+
+    def _save_checkpoint(self, completed):
+        last_event_id = self.checkpoint_tracker.last_event_id
+        if last_event_id is None and not completed:
+            return
+        failed_event_ids = sorted(self.checkpoint_tracker.failed)
+        self.checkpoint_store.set(
+            {
+                'last_event_id': last_event_id,
+                'failed_event_ids': failed_event_ids,
+                'completed': completed and not failed_event_ids,
+            },
+            *(self.checkpoint_key + (self.checkpoint_phase,))
         )
 
+    def get_current_watermark(self, query_options):
+        """
+            Last change of the orders of the period, read before the scan so orders
+            changed while the run goes on are picked up by the next one.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(self.watermark_query, query_options)
+            watermark = cursor.fetchone()[0]
+        if isinstance(watermark, dt):
+            return watermark.strftime('%Y-%m-%d %H:%M:%S.%f')
+        return watermark
+
+    def get_watermark(self):
+        """
+            Stored under the checkpoint key, so --event and --user runs never move the
+            watermark of the full runs.
+        """
+        stored = self.checkpoint_store.get(*(self.checkpoint_key + (WATERMARK,)))
+        return stored['changed'] if stored else None
+
+    def save_watermark(self, watermark):
+        """
+            Only called after runs without errors, so the events that failed are
+            generated again by the next incremental run. Nothing is stored in dry runs.
+        """
+        if self.dry_run or watermark is None:
+            return
+        self.checkpoint_store.set({'changed': watermark}, *(self.checkpoint_key + (WATERMARK,)))
+
     def get_query_results(self, query_options, query):
-        query_results = []
+        if self.stream_results:
+            return self.stream_query_results(query_options, query)
 
         with connection.cursor() as cursor:
             cursor.execute(
                 query,
                 query_options
             )
-            response = cursor.fetchall()
+            row_type = get_row_type(cursor.description)
+            return [row_type._make(row) for row in cursor.fetchall()]
 
-            columns = [col[0] for col in cursor.description]
-            for row in response:
-                data = {}
-                for index, item in enumerate(row):
-                    if not data.get(row[0], False):
-                        data[columns[index]] = row[index]
-                query_results.append(data)
+    def stream_query_results(self, query_options, query):
+        """
+            Yield the query rows lazily, reading them from an unbuffered server side
+            cursor in chunks of FETCH_SIZE. No other query can be sent through the
+            connection until the generator is exhausted.
+        """
+        cursor = self._server_side_cursor()
+        try:
+            cursor.execute(
+                query,
+                query_options
+            )
+            row_type = get_row_type(cursor.description)
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row_type._make(row)
+        finally:
+            cursor.close()
 
-            return query_results
+    def _server_side_cursor(self):
+        if connection.vendor == 'mysql':
+            from MySQLdb.cursors import SSCursor
+            connection.ensure_connection()
+            return connection.connection.cursor(SSCursor)
+        return connection.cursor()
 
     def iterate_querys_results(self, query_results, localize_start_date, localize_end_date):
-        for result in query_results:
-
-            payment_option = {
-                'epp_country': result['epp_country'],
-                'epp_name_on_account': result['epp_name_on_account'],
-                'epp_address1': result['epp_address1'],
-                'epp_address2': result['epp_address2'],
-                'epp_zip': result['epp_zip'],
-                'epp_city': result['epp_city'],
-                'epp_state': result['epp_state'],
-                'epp_tax_identifier': result['epp_tax_identifier'],
-            }
+        if self.workers > 1:
+            self.dispatch_concurrently(query_results, localize_start_date, localize_end_date)
+            return
 
-            event = {
-                'id': result['event_id'],
-                'user_id': result['user_id'],
-                'currency': result['currency'],
-            }
+        for result, amounts in self.with_amounts(query_results):
+            self.checkpoint_tracker.start(result.event_id)
+            self.process_result(result, localize_start_date, localize_end_date, amounts=amounts)
+        self.flush_batch()
 
-            tax_receipt_orders = {
-                'payment_transactions_count': result['payment_transactions_count'],
-                'total_tax_amount': result['total_tax_amount'],
-                'base_amount': result['base_amount'],
-                'total_taxable_amount_with_tax_amount': result['total_taxable_amount_with_tax_amount']
-            }
+    def with_amounts(self, query_results):
+        """
+            Pair each result with its (base, taxable) amounts in cents. With columnar
+            the amounts are computed FETCH_SIZE results at a time from the cents
+            summed by the query, otherwise they are None and computed while building
+            the payload.
+        """
+        if not self.columnar:
+            for result in query_results:
+                yield result, None
+            return
+
+        query_results = iter(query_results)
+        while True:
+            chunk = list(islice(query_results, FETCH_SIZE))
+            if not chunk:
+                break
+            amounts = chunk_amounts(chunk) or [None] * len(chunk)
+            for pair in zip(chunk, amounts):
+                yield pair
+
+    def dispatch_concurrently(self, query_results, localize_start_date, localize_end_date):
+        """
+            Process the results in a pool of self.workers threads. The number of results
+            waiting in the pool is bounded so the query results are still read lazily.
+        """
+        pool = ThreadPool(self.workers)
+        pending = threading.BoundedSemaphore(self.workers * 2)
+
+        def process(result, amounts):
+            try:
+                self.process_result(result, localize_start_date, localize_end_date, amounts=amounts)
+            except Exception as e:
+                self._log_exception(e, result.event_id)
+            finally:
+                pending.release()
 
-            if result['payment_transactions_count'] > 0:
-                # EB-28811: some eb_tax in DB has Null
-                if result['total_tax_amount'] is None:
-                    result['total_tax_amount'] = Decimal('0.00')
+        try:
+            for result, amounts in self.with_amounts(query_results):
+                pending.acquire()
+                self.checkpoint_tracker.start(result.event_id)
+                pool.apply_async(process, (result, amounts))
+        finally:
+            pool.close()
+            pool.join()
+        self.flush_batch()
 
+    def process_result(self, result, localize_start_date, localize_end_date, amounts=None):
+        self.metrics.count('rows')
+        self._process_result(result, localize_start_date, localize_end_date, amounts, default_timer())
+
+    def _process_result(self, result, localize_start_date, localize_end_date, amounts, read_at=None):
+        if result.payment_transactions_count > 0:
+            if self.log_event():
                 self.logger.info(
-                    "Processing event: {event} total_taxable_amount_with_tax_amount: {ttawta} base_amount: {base_amount} total_tax_amount: {total_tax_amount} payment_transactions_count: {payment_trans_count}".format(
-                        event=result['event_id'],
-                        ttawta=str(tax_receipt_orders['total_taxable_amount_with_tax_amount']),
-                        base_amount=str(tax_receipt_orders['base_amount']),
-                        total_tax_amount=str(tax_receipt_orders['total_tax_amount']),
-                        payment_trans_count=tax_receipt_orders['payment_transactions_count']
-                    )
+                    "Processing event: %s total_taxable_amount_with_tax_amount: %s base_amount: %s total_tax_amount: %s payment_transactions_count: %s",
+                    result.event_id,
+                    result.total_taxable_amount_with_tax_amount,
+                    result.base_amount,
+                    result.total_tax_amount,
+                    result.payment_transactions_count
                 )
 
-                try:
-                    self.generate_tax_receipts(
-                        payment_option,
-                        event,
-                        localize_start_date,
-                        localize_end_date,
-                        tax_receipt_orders
-                    )
-                except Exception as e:
-                    self._log_exception(e, event['id'])
+            try:
+                self.generate_tax_receipt_from_row(
+                    result,
+                    localize_start_date,
+                    localize_end_date,
+                    amounts=amounts,
+                    read_at=read_at
+                )
+            except Exception as e:
+                self._log_exception(e, result.event_id)
+        else:
+            self.checkpoint_tracker.finish(result.event_id)
 
     def generate_tax_receipts(
             self,
@@ -254,30 +750,55 @@ class TaxReceiptGenerator():
             localize_end_date,
             tax_receipt_orders
     ):
-        EB_TAX_INFO = settings.EVENTBRITE_TAX_INFORMATION[payment_option['epp_country']]
+        row = GenerationRow(
+            event_id=event['id'],
+            user_id=event['user_id'],
+            event_parent=event.get('event_parent'),
+            currency=event['currency'],
+            **dict(payment_option, **tax_receipt_orders)
+        )
+        self.generate_tax_receipt_from_row(row, localize_start_date, localize_end_date)
+
+    def generate_tax_receipt_from_row(self, row, localize_start_date, localize_end_date, amounts=None, read_at=None):
+        """
+            read_at is when the row was read, the 'event' latency histogram goes from
+            then to the answer of billing (or the dry run output).
+        """
+        orders_kwargs = self.build_tax_receipt_payload(
+            row,
+            localize_start_date,
+            localize_end_date,
+            amounts=amounts
+        )
+
+        if not self.dry_run:
+            self.add_to_batch(row.event_id, orders_kwargs, read_at)
+        else:
+            self.call_service(orders_kwargs)
+            self.observe_event(read_at)
+            self.checkpoint_tracker.finish(row.event_id)
+
+    def get_payload_template(self, country, localize_start_date, localize_end_date):
+        """
+            Return the part of the payload shared by every tax receipt of a country and
+            period (supplier information and period dates), built once per run.
+        """
+        key = (country, localize_start_date, localize_end_date)
+        template = self._payload_templates.get(key)
+        if template is not None:
+            return template
+
+        EB_TAX_INFO = settings.EVENTBRITE_TAX_INFORMATION[country]
         if not EB_TAX_INFO:
             raise Exception('Cannot find EVENTBRITE_TAX_INFORMATION in settings')
 
-        total_taxable_amount = (
-            tax_receipt_orders['total_taxable_amount_with_tax_amount'] - tax_receipt_orders['total_tax_amount']
-        )
-        orders_kwargs = {
+        start_date = localize_start_date.strftime(DATE_FORMAT)
+        end_date = localize_end_date.strftime(DATE_FORMAT)
+        template = {
             'tax_receipt': {
-                'user_id': str(event['user_id']),
-                'event_id': str(event['id']),
-                'reporting_country_code': payment_option['epp_country'],
-                'currency': event['currency'],
-                'base_amount': {
-                    'value': int(tax_receipt_orders['base_amount'] * 100),
-                    'currency': event['currency'],
-                },
-                'total_taxable_amount': {
-                    'value': int(total_taxable_amount * 100),
-                    'currency': event['currency'],
-                },
-                'payment_transactions_count': tax_receipt_orders['payment_transactions_count'],
-                'start_date_period': localize_start_date.strftime(DATE_FORMAT),
-                'end_date_period': localize_end_date.strftime(DATE_FORMAT),
+                'reporting_country_code': country,
+                'start_date_period': start_date,
+                'end_date_period': end_date,
                 'description': '',
                 'supplier_type': 'EVENTBRITE',
                 'supplier_name': EB_TAX_INFO['supplier_name'],
@@ -286,64 +807,237 @@ class TaxReceiptGenerator():
                 'supplier_postal_code': EB_TAX_INFO['supplier_postal_code'],
                 'supplier_city': EB_TAX_INFO['supplier_city'],
                 'supplier_region': EB_TAX_INFO['supplier_region'],
+                # Shared by all the payloads of the run, it must not be modified
                 'supplier_tax_information': {
                     'tax_identifier_type': EB_TAX_INFO['tax_identifier_type'],
-                    'tax_identifier_country': payment_option['epp_country'],
+                    'tax_identifier_country': country,
                     'tax_identifier_number': EB_TAX_INFO['tax_identifier_number'],
                 },
-                'recipient_name': payment_option['epp_name_on_account'],
                 'recipient_type': 'ORGANIZER',
-                'recipient_address': payment_option['epp_address1'],
-                'recipient_address_2': payment_option['epp_address2'],
-                'recipient_postal_code': payment_option['epp_zip'],
-                'recipient_city': payment_option['epp_city'],
-                'recipient_region': payment_option['epp_state'],
-                'tax_receipt_period_details': [{
-                    'reference_type': 'ORDER',
-                    'start_date': localize_start_date.strftime(DATE_FORMAT),
-                    'end_date': localize_end_date.strftime(DATE_FORMAT),
-                    'tax_rate': 0,
-                    'base_amount': {
-                        'value': int(tax_receipt_orders['base_amount'] * 100),
-                        'currency': event['currency'],
-                    },
-                    'taxable_amount': {
-                        'value': int(total_taxable_amount * 100),
-                        'currency': event['currency'],
-                    },
-                }],
-            }
+            },
+            'tax_receipt_period_detail': {
+                'reference_type': 'ORDER',
+                'start_date': start_date,
+                'end_date': end_date,
+                'tax_rate': 0,
+            },
         }
+        self._payload_templates[key] = template
+        return template
+
+    def build_tax_receipt_payload(self, row, localize_start_date, localize_end_date, amounts=None):
+        """
+            amounts are the (base, taxable) amounts in cents when already computed
+            for the whole chunk of rows. In multi country runs the period is the
+            localized window of the country of the row.
+        """
+        localize_start_date, localize_end_date = self.country_windows.get(
+            row.epp_country,
+            (localize_start_date, localize_end_date)
+        )
+        template = self.get_payload_template(
+            row.epp_country,
+            localize_start_date,
+            localize_end_date
+        )
+        currency = row.currency
+        if amounts is not None:
+            base_amount, total_taxable_amount = amounts
+        else:
+            # EB-28811: some eb_tax in DB has Null
+            total_tax_amount = row.total_tax_amount if row.total_tax_amount is not None else Decimal('0.00')
+            base_amount = int(row.base_amount * 100)
+            total_taxable_amount = int((row.total_taxable_amount_with_tax_amount - total_tax_amount) * 100)
+
+        period_detail = dict(template['tax_receipt_period_detail'])
+        period_detail['base_amount'] = {'value': base_amount, 'currency': currency}
+        period_detail['taxable_amount'] = {'value': total_taxable_amount, 'currency': currency}
 
-        if payment_option['epp_tax_identifier']:
-            orders_kwargs['tax_receipt']['recipient_tax_information'] = {
+        tax_receipt = dict(template['tax_receipt'])
+        tax_receipt['user_id'] = str(row.user_id)
+        tax_receipt['event_id'] = str(row.event_id)
+        tax_receipt['currency'] = currency
+        tax_receipt['base_amount'] = {'value': base_amount, 'currency': currency}
+        tax_receipt['total_taxable_amount'] = {'value': total_taxable_amount, 'currency': currency}
+        tax_receipt['payment_transactions_count'] = row.payment_transactions_count
+        tax_receipt['recipient_name'] = row.epp_name_on_account
+        tax_receipt['recipient_address'] = row.epp_address1
+        tax_receipt['recipient_address_2'] = row.epp_address2
+        tax_receipt['recipient_postal_code'] = row.epp_zip
+        tax_receipt['recipient_city'] = row.epp_city
+        tax_receipt['recipient_region'] = row.epp_state
+        tax_receipt['tax_receipt_period_details'] = [period_detail]
+
+        if row.epp_tax_identifier:
+            tax_receipt['recipient_tax_information'] = {
                 'tax_identifier_type': self.get_epp_tax_identifier_type(
-                    payment_option['epp_country'],
-                    payment_option['epp_tax_identifier']
+                    row.epp_country,
+                    row.epp_tax_identifier
                 ),
-                'tax_identifier_country': payment_option['epp_country'],
-                'tax_identifier_number': payment_option['epp_tax_identifier'],
+                'tax_identifier_country': row.epp_country,
+                'tax_identifier_number': row.epp_tax_identifier,
             }
 
-        if not self.dry_run:
-            client = control.Client('billing')
-            job = client.new_job()
-            auth_token = get_noninteractive_token([PERMISSION_USER_PAYMENTS_USER_INSTRUMENTS.value])['token']
-            job.control.auth = auth_token
-            job.create_tax_receipt(**orders_kwargs)
-            response = client.send_job(job)
-            if response.is_error():
-                raise Exception(str(response.actions[0].error_detail))
+        return {'tax_receipt': tax_receipt}
+
+    def open_billing_clients(self):
+        """
+            Start the pool of billing clients used during the run. Clients are created
+            on demand, at most one per worker, and reused by every job afterwards.
+        """
+        with self._clients_lock:
+            if self._billing_clients is None:
+                self._billing_clients = Queue.Queue()
+                self._billing_clients_count = 0
+
+    def close_billing_clients(self):
+        with self._clients_lock:
+            if self._billing_clients is None:
+                return
+            while not self._billing_clients.empty():
+                client = self._billing_clients.get()
+                close = getattr(client, 'close', None)
+                if callable(close):
+                    close()
+            self._billing_clients = None
+
+    @contextmanager
+    def billing_client(self):
+        self.open_billing_clients()
+        client = self._get_billing_client()
+        try:
+            yield client
+        finally:
+            self._billing_clients.put(client)
+
+    def _get_billing_client(self):
+        with self._clients_lock:
+            max_clients = max(self.workers, self.max_in_flight)
+            if self._billing_clients.empty() and self._billing_clients_count < max_clients:
+                self._billing_clients_count = self._billing_clients_count + 1
+                return control.Client('billing')
+        return self._billing_clients.get()
+
+    def add_to_batch(self, event_id, orders_kwargs, read_at=None):
+        with self._batch_lock:
+            self._batch.append((event_id, orders_kwargs, read_at))
+            if len(self._batch) < self.batch_size:
+                return
+            batch, self._batch = self._batch, []
+        self.dispatch_batch(batch)
+
+    def flush_batch(self):
+        """
+            Send the pending batch and wait for the batches still in flight.
+        """
+        with self._batch_lock:
+            batch, self._batch = self._batch, []
+        if batch:
+            self.dispatch_batch(batch)
+        self.wait_in_flight()
+
+    def start_dispatcher(self):
+        """
+            With max_in_flight the batches are sent from a pool of threads, so the
+            query results keep being read while billing answers. At most
+            max_in_flight batches are sent at the same time, reading waits when
+            the limit is reached.
+        """
+        if self.max_in_flight and self._dispatch_pool is None:
+            self._in_flight = threading.BoundedSemaphore(self.max_in_flight)
+            self._dispatch_pool = ThreadPool(self.max_in_flight)
+
+    def stop_dispatcher(self):
+        if self._dispatch_pool is None:
+            return
+        self._dispatch_pool.close()
+        self._dispatch_pool.join()
+        self._dispatch_pool = None
+        self._in_flight = None
+
+    def dispatch_batch(self, batch):
+        if self._dispatch_pool is None:
+            self.send_tax_receipts_batch(batch)
+            return
+        self._in_flight.acquire()
+        self._dispatch_pool.apply_async(self._send_in_flight, (batch,))
+
+    def _send_in_flight(self, batch):
+        try:
+            self.send_tax_receipts_batch(batch)
+        finally:
+            self._in_flight.release()
+
+    def wait_in_flight(self):
+        if self._in_flight is None:
+            return
+        # Every slot is free once the batches in flight are sent
+        for _ in range(self.max_in_flight):
+            self._in_flight.acquire()
+        for _ in range(self.max_in_flight):
+            self._in_flight.release()
+
+    def send_tax_receipts_batch(self, batch):
+        """
+            Send one create_tax_receipt action per (event_id, orders_kwargs, read_at) of
+            the batch in a single job, and count each action result against its event.
+        """
+        try:
+            with self.billing_client() as client:
+                job = client.new_job()
+                job.control.auth = self.token_cache.get_token([PERMISSION_USER_PAYMENTS_USER_INSTRUMENTS.value])
+                for event_id, orders_kwargs, read_at in batch:
+                    job.create_tax_receipt(**orders_kwargs)
+                try:
+                    with self.metrics.timer('billing'):
+                        response = client.send_job(job)
+                finally:
+                    for event_id, orders_kwargs, read_at in batch:
+                        self.observe_event(read_at)
+                self.metrics.count('billing_actions', len(batch))
+            if is_auth_error(response):
+                # The next batches get a new token
+                self.token_cache.invalidate([PERMISSION_USER_PAYMENTS_USER_INSTRUMENTS.value])
+        except Exception as e:
+            for event_id, orders_kwargs, read_at in batch:
+                self._log_exception(e, event_id)
+            self.save_checkpoint()
+            return
+
+        actions = list(response.actions or [])
+        error = None
+        if len(actions) != len(batch):
+            error = Exception('Billing answered {} actions for a batch of {} tax receipts: {}'.format(
+                len(actions),
+                len(batch),
+                response.pretty_error() if response.is_error() else 'no error',
+            ))
+        elif response.is_error() and not any(action.error_detail for action in actions):
+            error = Exception('Billing job failed: {}'.format(response.pretty_error()))
+        if error is not None:
+            # The actions can't be matched with the events, none of them is counted as generated
+            for event_id, orders_kwargs, read_at in batch:
+                self._log_exception(error, event_id)
+            self.save_checkpoint()
+            return
+
+        for (event_id, orders_kwargs, read_at), action in zip(batch, actions):
+            if response.is_error() and action.error_detail:
+                self._log_exception(Exception(str(action.error_detail)), event_id)
             else:
-                self.logger.info(
-                    'Generated Tax Receipt: event: %i response: %s' % (
-                        event['id'],
-                        response,
-                    )
-                )
-                self.cont_tax_receipts = self.cont_tax_receipts + 1
-        else:
-            self.call_service(orders_kwargs)
+                if self.log_event():
+                    self.logger.info('Generated Tax Receipt: event: %i response: %s', event_id, action)
+                with self._counters_lock:
+                    self.cont_tax_receipts = self.cont_tax_receipts + 1
+                self.checkpoint_tracker.finish(event_id)
+        self.save_checkpoint()
+
+    def observe_event(self, read_at):
+        if read_at is not None:
+            self.metrics.observe('event', default_timer() - read_at)
+
+    def _fetch_billing_token(self, permissions):
+        return get_noninteractive_token(permissions)
 
     def get_epp_tax_identifier_type(self, epp_country, epp_tax_identifier):
         if not self.dry_run:
@@ -362,16 +1056,37 @@ class TaxReceiptGenerator():
         return ''
 
     def call_service(self, orders_kwargs):
-        self.cont_tax_receipts = self.cont_tax_receipts + 1
-        self.output_dict.update({orders_kwargs['tax_receipt']['event_id']: orders_kwargs})
+        """
+            Keep the payload of the dry run, in output_dict or streamed to the
+            dry_run_output file.
+        """
+        event_id = orders_kwargs['tax_receipt']['event_id']
+        if self.dry_run_sink:
+            self.dry_run_sink.write(event_id, orders_kwargs)
+        with self._counters_lock:
+            self.cont_tax_receipts = self.cont_tax_receipts + 1
+            if not self.dry_run_sink:
+                self.output_dict.update({event_id: orders_kwargs})
+
+    def log_event(self):
+        """
+            Per event lines are only logged for one of every log_every calls (never
+            with 0), and only when INFO is enabled.
+        """
+        if not self.log_every or not self.logger.isEnabledFor(logging.INFO):
+            return False
+        return next(self._event_logs) % self.log_every == 0
 
     def enable_logging(self):
+        if any(getattr(handler, 'generation_console', False) for handler in self.logger.handlers):
+            return
         console = logging.StreamHandler()
         console.setLevel(logging.INFO)
         formatter = logging.Formatter(
             '%(name)-12s: %(levelname)-8s %(message)s'
         )
         console.setFormatter(formatter)
+        console.generation_console = True
         self.logger.addHandler(console)
 
     def _log_exception(self, e, event_id=None, quiet=False):
@@ -381,16 +1096,86 @@ class TaxReceiptGenerator():
             self.dry_run
         )
         self.logger.error(message)
-        self.error_cont = self.error_cont + 1
+        with self._counters_lock:
+            self.error_cont = self.error_cont + 1
+        if event_id is not None:
+            self.checkpoint_tracker.finish(event_id, failed=True)
+
+
+def run_shards(request, generator_kwargs):
+    """
+        Run every shard of the request in its own process and merge the counters.
+        Each process opens its own DB connection and billing clients, and only the
+        parent posts the Slack messages and the mail report.
+    """
+    generator = TaxReceiptGenerator(**generator_kwargs)
+    if not generator.dry_run:
+        generator.notify_start(request)
+
+    # The shards can't share the parent connection, each one opens its own
+    connections.close_all()
+    results = multiprocessing.Queue()
+    processes = []
+    for shard_index in range(request.shards):
+        shard_request = copy.copy(request)
+        shard_request.shard_index = shard_index
+        process = multiprocessing.Process(
+            target=_run_shard,
+            args=(shard_request, generator_kwargs, results),
+        )
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+
+    # The results are small, every shard that exited normally already wrote its own
+    reported = set()
+    while len(reported) < len(processes):
+        try:
+            shard_index, generated, errors = results.get(timeout=SHARD_RESULT_TIMEOUT)
+        except Queue.Empty:
+            break
+        reported.add(shard_index)
+        generator.logger.info(
+            "Shard {}: tax receipts generated: {} errors: {}".format(shard_index, generated, errors)
+        )
+        generator.cont_tax_receipts = generator.cont_tax_receipts + generated
+        generator.error_cont = generator.error_cont + errors
+    for shard_index, process in enumerate(processes):
+        if shard_index not in reported:
+            generator.logger.error(
+                "Shard {} exited with code {} without reporting its results".format(shard_index, process.exitcode)
+            )
+            generator.error_cont = generator.error_cont + 1
+
+    generator.logger.info("Tax receipts generated in all shards: {}".format(generator.cont_tax_receipts))
+    generator.logger.info("Errors in all shards: {}".format(generator.error_cont))
+    if not generator.dry_run:
+        generator.notify_end(request)
+    return generator
+
+
+def _run_shard(request, generator_kwargs, results):
+    generator = TaxReceiptGenerator(**generator_kwargs)
+    generator.notify = False
+    try:
+        generator.run(request)
+    except Exception as e:
+        generator._log_exception(e)
+    finally:
+        results.put((request.shard_index, generator.cont_tax_receipts, generator.error_cont))
 
 
 class TaxReceiptGeneratorRequest(object):
 
-    def __init__(self, country, today_date, user_id, event_id):
+    def __init__(self, country, today_date, user_id, event_id, shards=1, shard_index=None):
         self.country = country
         self.today_date = today_date
         self.user_id = user_id
         self.event_id = event_id
+        self.shards = shards
+        self.shard_index = shard_index
         self._validate()
         self._post_validate()
 
@@ -399,14 +1184,26 @@ class TaxReceiptGeneratorRequest(object):
             Check if the params passed to the tax_receipt_generator are ok.
         """
         if self.country:
-            if self.country not in settings.EVENTBRITE_TAX_INFORMATION:
-                raise CountryNotConfiguredException()
+            if isinstance(self.country, basestring):
+                countries = self.country.split(',')
+            else:
+                countries = self.country
+            # Sorted and without repeats, the checkpoint key is built from them
+            self.countries = sorted(set(country.strip() for country in countries))
+            for country in self.countries:
+                if country not in settings.EVENTBRITE_TAX_INFORMATION:
+                    raise CountryNotConfiguredException()
         else:
             raise NoCountryProvidedException()
 
         if self.user_id and self.event_id:
             raise UserAndEventProvidedException()
 
+        if self.shards < 1 or (
+            self.shard_index is not None and not 0 <= self.shard_index < self.shards
+        ):
+            raise InvalidShardException()
+
         if self.today_date:
             try:
                 self.today = dt.strptime(self.today_date, '%Y-%m-%d')
@@ -443,6 +1240,12 @@ class NoCountryProvidedException(Exception):
         super(NoCountryProvidedException, self).__init__(self.message)
 
 
+class InvalidShardException(Exception):
+    def __init__(self):
+        self.message = 'The shard index must be between 0 and the number of shards - 1'
+        super(InvalidShardException, self).__init__(self.message)
+
+
 class IncorrectFormatDateException(Exception):
     def __init__(self):
         self.message = 'Date is not matching format YYYY-MM-DD'
@@ -4,15 +4,29 @@ from __future__ import unicode_literals
 from django.test import TestCase
 
 from datetime import datetime as dt
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
 from time import sleep
+from unittest import skipUnless
 import random
 import string
-from mock import patch
+from StringIO import StringIO
+import sys
+import threading
+import types
+from mock import Mock, patch
 
 from django.core.management.base import CommandError
+from django.db import connection
 
 from invoicing_app.management.commands.generate_tax_receipts_old import Command as CommandOld
 from invoicing_app.management.commands.generate_tax_receipts_new import Command as CommandNew
+from invoicing_app.management.commands.compare import Command as CompareCommand
+from invoicing_app.management.commands.declare_pending_tax_receipts import Command as DeclarePendingCommand
 from invoicing_app.management.commands.update_incomplete_tax_receipts import Command as UpdateIncompleteCommand
 
 from factories.user import UserFactory
@@ -21,15 +35,36 @@ from factories.paymentoptions import PaymentOptionsFactory
 from factories.order import OrderFactory
 from factories.tax_receipts import TaxReceiptsFactory
 from factories.users_tax_regimes import UserTaxRegimesFactory
+from invoicing import settings
+from invoicing_app.checkpoint import CheckpointStore, CheckpointTracker
+from invoicing_app.batch_sizer import AdaptiveBatchSizer
+from invoicing_app.benchmark import (
+    BillingStub,
+    GenerationBenchmark,
+)
 from invoicing_app.circuitbreaker import CircuitBreaker
+from invoicing_app.columnar import chunk_amounts, numpy
+from invoicing_app.dry_run_sink import NdjsonSink, read_ndjson, shard_path
+from invoicing_app.models import Order, OrderRollup
+from invoicing_app.order_rollup import OrderRollupUpdater
+from invoicing_app.run_metrics import RunMetrics
+from invoicing_app.token_cache import TokenCache, is_auth_error
 
 from invoicing_app.tax_receipt_generator import (
+    ColumnarGenerationRow,
     CountryNotConfiguredException,
+    GenerationRow,
     IncorrectFormatDateException,
+    InvalidShardException,
+    NAME_LOGGING,
     NoCountryProvidedException,
+    PARENT_CHILD_MASKS,
+    PHASE_ALL,
+    PHASE_CHILD,
     TaxReceiptGenerator,
     TaxReceiptGeneratorRequest,
-    UserAndEventProvidedException
+    UserAndEventProvidedException,
+    run_shards,
 )
 
 from decimal import Decimal
@@ -43,6 +78,45 @@ path_tax_receipt_generator = 'invoicing_app.tax_receipt_generator.TaxReceiptGene
 generate_script_name = 'generate_entry_point'
 
 
+def build_generation_result(event_id, **kwargs):
+    result = {
+        'event_id': event_id,
+        'user_id': 1,
+        'event_parent': None,
+        'currency': 'ARS',
+        'epp_country': 'AR',
+        'epp_name_on_account': '',
+        'epp_address1': '',
+        'epp_address2': '',
+        'epp_zip': '',
+        'epp_city': '',
+        'epp_state': '',
+        'epp_tax_identifier': '',
+        'payment_transactions_count': 1,
+        'total_tax_amount': Decimal('1.1'),
+        'total_taxable_amount_with_tax_amount': Decimal('5.1'),
+        'base_amount': Decimal('1.1'),
+    }
+    result.update(kwargs)
+    return GenerationRow(**result)
+
+
+def set_checkpoints(path, command):
+    checkpoint_store = CheckpointStore(path)
+    for index in range(50):
+        checkpoint_store.set({'index': index}, command, index)
+
+
+def build_columnar_result(event_id, **kwargs):
+    row = build_generation_result(event_id, **kwargs)
+    # The cents summed by CENTS_COLUMNS
+    return ColumnarGenerationRow(*(row + (
+        int(row.base_amount * 100),
+        int(row.total_taxable_amount_with_tax_amount * 100),
+        int((row.total_tax_amount or 0) * 100),
+    )))
+
+
 class TestScriptGenerateTaxReceiptsOldAndNew(TestCase):
     """
         Unittest for old and new scripts
@@ -847,6 +921,818 @@ class TestCircuitBreaker(TestCase):
         self.assertEquals(str(self.circuit_breaker), expected_str)
 
 
+class TestTokenCache(TestCase):
+    def setUp(self):
+        self.fetch_token = Mock(side_effect=lambda permissions: 'token-{}'.format(self.fetch_token.call_count))
+        self.token_cache = TokenCache(self.fetch_token, ttl=60, refresh_margin=10)
+
+    def test_token_is_cached(self):
+        self.assertEqual(self.token_cache.get_token(['a', 'b']), 'token-1')
+        self.assertEqual(self.token_cache.get_token(['b', 'a']), 'token-1')
+        self.assertEqual(self.fetch_token.call_count, 1)
+
+    def test_token_per_permission_set(self):
+        self.token_cache.get_token(['a'])
+        self.token_cache.get_token('b')
+        self.assertEqual(self.fetch_token.call_count, 2)
+
+    @patch('invoicing_app.token_cache.default_timer')
+    def test_token_refreshed_before_expiry(self, patch_timer):
+        patch_timer.return_value = 1000
+        self.token_cache.get_token(['a'])
+        patch_timer.return_value = 1049
+        self.assertEqual(self.token_cache.get_token(['a']), 'token-1')
+        # Inside the refresh margin
+        patch_timer.return_value = 1051
+        self.assertEqual(self.token_cache.get_token(['a']), 'token-2')
+
+    @patch('invoicing_app.token_cache.default_timer')
+    def test_token_expires_in(self, patch_timer):
+        patch_timer.return_value = 1000
+        token_cache = TokenCache(Mock(return_value={'token': 'abc', 'expires_in': 20}), ttl=60, refresh_margin=10)
+        self.assertEqual(token_cache.get_token(['a']), 'abc')
+        patch_timer.return_value = 1011
+        token_cache.get_token(['a'])
+        self.assertEqual(token_cache._fetch_token.call_count, 2)
+
+    def test_concurrent_refresh_once(self):
+        def slow_fetch(permissions):
+            sleep(0.1)
+            return 'token'
+        fetch_token = Mock(side_effect=slow_fetch)
+        token_cache = TokenCache(fetch_token)
+        threads = [threading.Thread(target=token_cache.get_token, args=(['a'],)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(fetch_token.call_count, 1)
+
+    def test_invalidate(self):
+        self.token_cache.get_token(['a'])
+        self.token_cache.get_token(['b'])
+        self.token_cache.invalidate(['a'])
+        self.assertEqual(self.token_cache.get_token(['a']), 'token-3')
+        self.assertEqual(self.token_cache.get_token(['b']), 'token-2')
+
+    def test_is_auth_error(self):
+        def response(is_error, pretty_error, error_detail=None):
+            return Mock(
+                is_error=Mock(return_value=is_error),
+                pretty_error=Mock(return_value=pretty_error),
+                actions=[Mock(error_detail=error_detail)],
+            )
+
+        self.assertTrue(is_auth_error(response(True, 'PERMISSION_DENIED: token expired')))
+        self.assertTrue(is_auth_error(response(True, '', error_detail='invalid_token')))
+        self.assertFalse(is_auth_error(response(True, 'invalid recipient')))
+        self.assertFalse(is_auth_error(response(False, 'PERMISSION_DENIED')))
+
+
+class TestCheckpoint(TestCase):
+    def setUp(self):
+        self.checkpoint_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.checkpoint_dir)
+        self.checkpoint_store = CheckpointStore(os.path.join(self.checkpoint_dir, 'checkpoints.json'))
+
+    def test_store(self):
+        self.assertIsNone(self.checkpoint_store.get('AR', '2020-03', 'child'))
+        self.checkpoint_store.set({'last_event_id': 10}, 'AR', '2020-03', 'child')
+        self.assertEqual(self.checkpoint_store.get('AR', '2020-03', 'child'), {'last_event_id': 10})
+        self.assertIsNone(self.checkpoint_store.get('BR', '2020-03', 'child'))
+        self.checkpoint_store.delete('AR', '2020-03', 'child')
+        self.assertIsNone(self.checkpoint_store.get('AR', '2020-03', 'child'))
+
+    def test_store_temporary_files(self):
+        with patch('invoicing_app.checkpoint.os.rename', side_effect=OSError('rename failed')):
+            with self.assertRaises(OSError):
+                self.checkpoint_store.set({'last_event_id': 10}, 'AR', '2020-03', 'child')
+        self.assertEqual(os.listdir(self.checkpoint_dir), ['checkpoints.json.lock'])
+        self.checkpoint_store.set({'last_event_id': 10}, 'AR', '2020-03', 'child')
+        self.assertEqual(sorted(os.listdir(self.checkpoint_dir)), ['checkpoints.json', 'checkpoints.json.lock'])
+
+    def test_store_processes(self):
+        # A declaration, a generation and a rollup update share the file
+        processes = [
+            multiprocessing.Process(target=set_checkpoints, args=(self.checkpoint_store.path, command))
+            for command in ('declare', 'generate', 'rollup')
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        for command in ('declare', 'generate', 'rollup'):
+            for index in range(50):
+                self.assertEqual(self.checkpoint_store.get(command, index), {'index': index})
+
+    def test_tracker_out_of_order(self):
+        tracker = CheckpointTracker()
+        for event_id in (1, 2, 3, 4):
+            tracker.start(event_id)
+        tracker.finish(2)
+        self.assertIsNone(tracker.last_event_id)
+        tracker.finish(1)
+        self.assertEqual(tracker.last_event_id, 2)
+        tracker.finish(4)
+        self.assertEqual(tracker.last_event_id, 2)
+        tracker.finish(3)
+        self.assertEqual(tracker.last_event_id, 4)
+
+    def test_tracker_failed(self):
+        tracker = CheckpointTracker(last_event_id=10, failed=[4])
+        for event_id in (4, 11, 12):
+            tracker.start(event_id)
+        tracker.finish(4)
+        tracker.finish(11, failed=True)
+        self.assertEqual(tracker.last_event_id, 11)
+        tracker.finish(12)
+        self.assertEqual(tracker.last_event_id, 12)
+        self.assertEqual(tracker.failed, {11})
+
+
+class TestOrderRollup(TestCase):
+    def setUp(self):
+        checkpoint_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, checkpoint_dir)
+        checkpoint_patch = patch.object(
+            settings, 'TAX_RECEIPTS_CHECKPOINT_FILE', os.path.join(checkpoint_dir, 'checkpoints.json')
+        )
+        checkpoint_patch.start()
+        self.addCleanup(checkpoint_patch.stop)
+        self.my_user = UserFactory.create()
+        self.parent_event = EventFactory.create(user=self.my_user, series=True)
+        PaymentOptionsFactory.create(event=self.parent_event)
+        self.child_event = EventFactory.create(
+            user=self.my_user, event_name='CHILD', series=True, event_parent=self.parent_event
+        )
+        self.single_event = EventFactory.create(user=self.my_user, event_name='SINGLE')
+        PaymentOptionsFactory.create(event=self.single_event)
+        orders = [
+            # 2020-02-29 in Argentina
+            (self.single_event, dt(2020, 3, 1, 2, 0), dt(2020, 3, 1, 2, 0), 100),
+            (self.single_event, dt(2020, 3, 8, 0, 0), dt(2020, 3, 10, 12, 0), 100),
+            (self.single_event, dt(2020, 3, 8, 1, 0), dt(2020, 3, 10, 14, 0), 100),
+            (self.single_event, dt(2020, 3, 9, 0, 0), dt(2020, 3, 9, 0, 0), 200),
+            # 2020-03-31 in Argentina
+            (self.single_event, dt(2020, 4, 1, 2, 0), dt(2020, 4, 1, 2, 0), 100),
+            (self.child_event, dt(2020, 3, 15, 0, 0), dt(2020, 3, 15, 0, 0), 100),
+            (self.child_event, dt(2020, 3, 20, 0, 0), dt(2020, 4, 2, 0, 0), 100),
+        ]
+        for event, pp_date, changed, status in orders:
+            OrderFactory.create(event=event, pp_date=str(pp_date), changed=str(changed), status=status)
+
+    def get_results(self, use_rollup, parent_child_mask):
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False, use_rollup=use_rollup)
+        query = generator.rollup_query if use_rollup else generator.query
+        query_options = {
+            'localize_start_date_query': '2020-03-01 03:00:00',
+            'localize_end_date_query': '2020-04-01 03:00:00',
+            'start_day_query': dt(2020, 3, 1).date(),
+            'end_day_query': dt(2020, 4, 1).date(),
+            'declarable_tax_receipt_countries_query': 'AR',
+            'status_query': 100,
+        }
+        results = generator.get_query_results(
+            query_options,
+            query.format(condition_mask='', parent_child_mask=parent_child_mask)
+        )
+        return [
+            (
+                result.event_id,
+                result.epp_country,
+                int(result.payment_transactions_count),
+                Decimal(str(result.base_amount)).quantize(Decimal('0.01')),
+                Decimal(str(result.total_taxable_amount_with_tax_amount)).quantize(Decimal('0.01')),
+                Decimal(str(result.total_tax_amount)).quantize(Decimal('0.01')),
+            )
+            for result in results
+        ]
+
+    def test_update(self):
+        updater = OrderRollupUpdater('AR')
+        updater.update()
+
+        self.assertEqual(updater.events_updated, 3)
+        self.assertEqual(
+            list(OrderRollup.objects.filter(event=self.single_event).values_list(
+                'pp_day', 'changed_day', 'orders_count'
+            ).order_by('pp_day')),
+            [
+                (dt(2020, 2, 29).date(), dt(2020, 2, 29).date(), 1),
+                (dt(2020, 3, 7).date(), dt(2020, 3, 10).date(), 2),
+                (dt(2020, 3, 31).date(), dt(2020, 3, 31).date(), 1),
+            ]
+        )
+
+    def test_update_incremental(self):
+        OrderRollupUpdater('AR').update()
+        OrderFactory.create(event=self.child_event, pp_date=str(dt(2020, 4, 5, 0, 0)), changed=str(dt(2020, 4, 5, 0, 0)))
+
+        updater = OrderRollupUpdater('AR')
+        updater.update()
+
+        self.assertEqual(updater.events_updated, 1)
+        self.assertEqual(OrderRollup.objects.filter(event=self.child_event).count(), 3)
+        self.assertEqual(OrderRollup.objects.filter(event=self.single_event).count(), 3)
+
+    def test_rollup_multi_country(self):
+        OrderRollupUpdater('AR').update()
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False, use_rollup=True)
+        generator.countries = ['AR', 'BR']
+        query = generator.route_countries(generator.rollup_query).format(
+            condition_mask='',
+            parent_child_mask='(`Events`.`id` = `Payment_Options`.`event`)'
+        )
+        query_options = {
+            'start_day_query': dt(2020, 3, 1).date(),
+            'end_day_query': dt(2020, 4, 1).date(),
+            'country_0_query': 'AR',
+            'country_1_query': 'BR',
+        }
+
+        results = generator.get_query_results(query_options, query)
+
+        self.assertEqual([result.event_id for result in results], [self.single_event.id])
+
+    def test_rollup_parity(self):
+        OrderRollupUpdater('AR').update()
+        masks = (
+            '(`Events`.`id` = `Payment_Options`.`event`)',
+            '(`Events`.`event_parent` = `Payment_Options`.`event`)',
+        )
+        for parent_child_mask in masks:
+            raw_results = self.get_results(False, parent_child_mask)
+            self.assertTrue(raw_results)
+            self.assertEqual(self.get_results(True, parent_child_mask), raw_results)
+
+
+@skipUnless(numpy, 'numpy is not installed')
+class TestColumnarAmounts(TestCase):
+    def setUp(self):
+        self.my_generator = TaxReceiptGenerator(dry_run=True, do_logging=False)
+        random.seed(10)
+        self.rows = [
+            build_columnar_result(
+                event_id,
+                base_amount=Decimal(random.randint(-10 ** 7, 10 ** 7)).scaleb(-random.randint(0, 2)),
+                total_taxable_amount_with_tax_amount=Decimal(random.randint(0, 10 ** 6)).scaleb(-random.randint(0, 2)),
+                total_tax_amount=random.choice([None, Decimal(random.randint(-10 ** 5, 10 ** 5)).scaleb(-2)]),
+            )
+            for event_id in range(1, 501)
+        ]
+
+    def row_amounts(self, row):
+        payload = self.my_generator.build_tax_receipt_payload(row, dt(2020, 3, 1, 3, 0), dt(2020, 4, 1, 3, 0))
+        return payload['tax_receipt']['base_amount']['value'], payload['tax_receipt']['total_taxable_amount']['value']
+
+    def test_chunk_amounts_parity(self):
+        self.assertEqual(chunk_amounts(self.rows), [self.row_amounts(row) for row in self.rows])
+
+    def test_chunk_amounts_missing(self):
+        self.assertIsNone(chunk_amounts([build_columnar_result(1)._replace(base_cents=None)]))
+        self.assertIsNone(chunk_amounts([]))
+
+    def test_columnar_generation(self):
+        columnar_generator = TaxReceiptGenerator(dry_run=True, do_logging=False, columnar=True)
+        start_date = dt(2020, 3, 1, 3, 0)
+        end_date = dt(2020, 4, 1, 3, 0)
+
+        self.my_generator.iterate_querys_results(self.rows, start_date, end_date)
+        columnar_generator.iterate_querys_results(self.rows, start_date, end_date)
+
+        self.assertEqual(columnar_generator.cont_tax_receipts, len(self.rows))
+        self.assertEqual(columnar_generator.output_dict, self.my_generator.output_dict)
+
+    def test_columnar_query_parity(self):
+        my_user = UserFactory.create()
+        for event_name, gross, mg_fee, eb_tax in (
+            ('FIRST', 1.5, 5.5, 1.5),
+            ('SECOND', 12.5, 7.5, 0),
+            ('THIRD', 99.5, 0.5, 2.5),
+        ):
+            my_event = EventFactory.create(user=my_user, event_name=event_name)
+            PaymentOptionsFactory.create(event=my_event)
+            OrderFactory.create(event=my_event, gross=gross, mg_fee=mg_fee, eb_tax=eb_tax)
+            OrderFactory.create(event=my_event, gross=gross, mg_fee=mg_fee, eb_tax=0.5, changed=str(dt(2020, 3, 11, 0, 0)))
+        checkpoint_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, checkpoint_dir)
+        with patch.object(settings, 'TAX_RECEIPTS_CHECKPOINT_FILE', os.path.join(checkpoint_dir, 'checkpoints.json')):
+            OrderRollupUpdater('AR').update()
+        request = TaxReceiptGeneratorRequest(country='AR', today_date='2020-04-01', user_id=None, event_id=None)
+
+        for use_rollup in (False, True):
+            generator = TaxReceiptGenerator(dry_run=True, do_logging=False, use_rollup=use_rollup)
+            generator.run(request)
+            columnar_generator = TaxReceiptGenerator(dry_run=True, do_logging=False, use_rollup=use_rollup, columnar=True)
+            with patch.object(columnar_generator, 'build_tax_receipt_payload', wraps=columnar_generator.build_tax_receipt_payload) as patch_build:
+                columnar_generator.run(request)
+
+            self.assertEqual(len(generator.output_dict), 3)
+            self.assertEqual(columnar_generator.output_dict, generator.output_dict)
+            # The amounts were summed in cents by the query
+            self.assertTrue(all(call[1]['amounts'] is not None for call in patch_build.call_args_list))
+
+
+class TestRunMetrics(TestCase):
+    def test_summary(self):
+        metrics = RunMetrics()
+        with metrics.timer('query'):
+            sleep(0.01)
+        with metrics.timer('query'):
+            pass
+        metrics.count('rows', 10)
+        for seconds in (0.0005, 0.002, 0.002, 10):
+            metrics.observe('event', seconds)
+
+        summary = metrics.summary()
+
+        self.assertEqual(summary['timers']['query']['calls'], 2)
+        self.assertGreaterEqual(summary['timers']['query']['seconds'], 0.01)
+        self.assertEqual(summary['counters'], {'rows': 10})
+        self.assertEqual(summary['histograms']['event']['count'], 4)
+        self.assertEqual(summary['histograms']['event']['max'], 10)
+        self.assertEqual(summary['histograms']['event']['buckets']['<=0.001s'], 1)
+        self.assertEqual(summary['histograms']['event']['buckets']['<=0.005s'], 2)
+        self.assertEqual(summary['histograms']['event']['buckets']['>5s'], 1)
+        self.assertGreater(metrics.rows_per_second('rows', ['query']), 0)
+        self.assertIsNone(metrics.rows_per_second('rows', ['iterate']))
+
+
+class TestDryRunSink(TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def test_write_and_read(self):
+        for name in ('payloads.ndjson', 'payloads.ndjson.gz'):
+            path = os.path.join(self.output_dir, name)
+            sink = NdjsonSink(path)
+            sink.write('1', {'tax_receipt': {'event_id': '1'}})
+            sink.write('2', {'tax_receipt': {'event_id': '2'}})
+            sink.close()
+
+            self.assertEqual(sink.written, 2)
+            self.assertEqual(
+                list(read_ndjson(path)),
+                [('1', {'tax_receipt': {'event_id': '1'}}), ('2', {'tax_receipt': {'event_id': '2'}})]
+            )
+        with open(os.path.join(self.output_dir, 'payloads.ndjson.gz'), 'rb') as gzip_file:
+            self.assertEqual(gzip_file.read(2), b'\x1f\x8b')
+
+    def test_empty_output(self):
+        path = os.path.join(self.output_dir, 'payloads.ndjson')
+        with open(path, 'w') as stale_file:
+            stale_file.write('{"event_id": "1", "payload": {}}\n')
+
+        sink = NdjsonSink(path)
+        sink.close()
+
+        self.assertEqual(list(read_ndjson(path)), [])
+
+    def test_compare_duplicated_event(self):
+        path = os.path.join(self.output_dir, 'payloads.ndjson')
+        sink = NdjsonSink(path)
+        sink.write('1', {'tax_receipt': {'event_id': '1'}})
+        sink.write('1', {'tax_receipt': {'event_id': '1'}})
+        sink.write('2', {'tax_receipt': {'event_id': '2'}})
+        sink.close()
+        old_results = {'1': {'tax_receipt': {'event_id': '1'}}, '2': {'tax_receipt': {'event_id': '2'}}}
+
+        self.assertTrue(CompareCommand().compare_output(path, old_results))
+        self.assertFalse(CompareCommand().compare_output(path, dict(old_results, **{'3': {}})))
+
+    def test_shard_path(self):
+        self.assertEqual(shard_path('/tmp/payloads.ndjson.gz', 1), '/tmp/payloads.shard-1.ndjson.gz')
+        self.assertEqual(shard_path('payloads', 0), 'payloads.shard-0')
+
+    def test_generator_output(self):
+        path = os.path.join(self.output_dir, 'payloads.ndjson.gz')
+        results = [build_generation_result(event_id) for event_id in range(1, 6)]
+        start_date = dt(2020, 3, 1, 3, 0)
+        end_date = dt(2020, 4, 1, 3, 0)
+        memory_generator = TaxReceiptGenerator(dry_run=True, do_logging=False)
+        memory_generator.iterate_querys_results(results, start_date, end_date)
+
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False, dry_run_output=path)
+        generator.dry_run_sink = NdjsonSink(path)
+        generator.iterate_querys_results(results, start_date, end_date)
+        generator.dry_run_sink.close()
+
+        self.assertEqual(generator.output_dict, {})
+        self.assertEqual(generator.cont_tax_receipts, 5)
+        self.assertEqual(dict(read_ndjson(path)), memory_generator.output_dict)
+
+    @patch.object(
+        TaxReceiptGenerator, 'localize_date', side_effect=lambda country, date: date
+    )
+    def test_run_output(self, patch_localize):
+        my_event = EventFactory.create(user=UserFactory.create())
+        PaymentOptionsFactory.create(event=my_event)
+        OrderFactory.create(event=my_event)
+        path = os.path.join(self.output_dir, 'payloads.ndjson')
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False, dry_run_output=path)
+
+        generator.run(TaxReceiptGeneratorRequest(country='AR', today_date='2020-04-01', user_id=None, event_id=None))
+
+        self.assertEqual([event_id for event_id, payload in read_ndjson(path)], [str(my_event.id)])
+
+
+class TestAdaptiveBatchSizer(TestCase):
+    def test_grows_under_target(self):
+        sizer = AdaptiveBatchSizer(100, 10, 120, target_latency=1)
+
+        self.assertEqual(sizer.record(100, 0.5), 110)
+        self.assertEqual(sizer.record(110, 0.5), 120)
+        self.assertIsNone(sizer.record(120, 0.5))
+        self.assertEqual(sizer.sizes, [100, 110, 120])
+
+    def test_smaller_batch_does_not_grow(self):
+        sizer = AdaptiveBatchSizer(100, 10, 1000, target_latency=1)
+
+        self.assertIsNone(sizer.record(40, 0.1))
+        self.assertEqual(sizer.size, 100)
+
+    def test_shrinks_on_error_and_latency(self):
+        sizer = AdaptiveBatchSizer(100, 30, 1000, target_latency=1)
+
+        self.assertEqual(sizer.record(100, 0.1, error=True), 50)
+        self.assertEqual(sizer.record(20, 2), 30)
+        self.assertIsNone(sizer.record(30, 2))
+
+
+@patch(
+    'invoicing_app.management.commands.declare_pending_tax_receipts.PERMISSION_USER_BILLING_CHARGE_SCHEDULES_READ',
+    create=True
+)
+@patch(
+    'invoicing_app.management.commands.declare_pending_tax_receipts.get_cron_auth_token', create=True
+)
+@patch(
+    'invoicing_app.management.commands.declare_pending_tax_receipts.TaxReceiptStatuses', create=True
+)
+@patch(
+    'invoicing_app.management.commands.declare_pending_tax_receipts.control', create=True
+)
+class TestDeclarePendingTaxReceipts(TestCase):
+    def setUp(self):
+        self.tax_receipt_ids = [
+            TaxReceiptsFactory.create(user_id=1, event_id=event_id, status_id=1).id for event_id in range(1, 11)
+        ]
+        self.failed_id = str(self.tax_receipt_ids[4])
+        self.sent_batches = []
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.failed_file = os.path.join(self.output_dir, 'failed.ndjson')
+        for name, value in (
+            ('TAX_RECEIPTS_BATCH_TO_DECLARE', 3),
+            ('TAX_RECEIPTS_DECLARE_BACKOFF', 0),
+            ('TAX_RECEIPTS_DECLARE_FAILED_FILE', self.failed_file),
+            ('TAX_RECEIPTS_CHECKPOINT_FILE', os.path.join(self.output_dir, 'checkpoints.json')),
+        ):
+            settings_patch = patch.object(settings, name, value, create=True)
+            settings_patch.start()
+            self.addCleanup(settings_patch.stop)
+
+    def billing_client(self, service):
+        client = Mock()
+
+        def send_job(job):
+            tax_receipt_ids = job.declare_tax_receipts.call_args[1]['tax_receipt_ids']
+            with self.lock:
+                self.sent_batches.append(tax_receipt_ids)
+                self.clients.add(id(client))
+            sleep(0.01)
+            return Mock(
+                is_error=Mock(return_value=self.failed_id in tax_receipt_ids),
+                pretty_error=Mock(return_value='INVALID_TAX_RECEIPT'),
+                actions=[],
+            )
+
+        client.send_job.side_effect = send_job
+        return client
+
+    def declare(self, workers):
+        command = DeclarePendingCommand()
+        command.dry_run = False
+        command.workers = workers
+        command.declare_pending_tax_receipts()
+        return command
+
+    def test_declare(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_control.Client.side_effect = self.billing_client
+
+        command = self.declare(1)
+
+        # The failing batch is retried and then split until only the failing id is left
+        failing_batch = [str(tax_receipt_id) for tax_receipt_id in self.tax_receipt_ids[3:6]]
+        self.assertEqual(self.sent_batches.count(failing_batch), 3)
+        self.assertEqual(self.sent_batches.count([self.failed_id]), 3)
+        self.assertEqual((command.declared, command.failed, command.failed_batches), (9, 1, 1))
+        with open(self.failed_file) as failed_file:
+            self.assertEqual([json.loads(line)['tax_receipt_id'] for line in failed_file], [self.failed_id])
+
+    def test_declare_workers(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_control.Client.side_effect = self.billing_client
+
+        command = self.declare(3)
+
+        self.assertEqual(
+            set(tax_receipt_id for batch in self.sent_batches for tax_receipt_id in batch),
+            set(str(tax_receipt_id) for tax_receipt_id in self.tax_receipt_ids)
+        )
+        self.assertEqual((command.declared, command.failed, command.failed_batches), (9, 1, 1))
+        self.assertEqual(patch_control.Client.call_count, 3)
+        self.assertGreater(len(self.clients), 1)
+        self.assertEqual(command.tracker.last_event_id, self.tax_receipt_ids[-1])
+
+    def test_declare_workers_batch_error(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_control.Client.side_effect = self.billing_client
+        self.failed_id = None
+        failing_ids = self.tax_receipt_ids[:5]
+        declare_batch = DeclarePendingCommand.declare_batch
+
+        def failing_declare_batch(command, client, tax_receipt_ids_batch):
+            if tax_receipt_ids_batch[0] in failing_ids:
+                raise IOError('No space left on device')
+            declare_batch(command, client, tax_receipt_ids_batch)
+
+        # More failing batches than workers and queued batches together
+        with patch.object(settings, 'TAX_RECEIPTS_BATCH_TO_DECLARE', 1), \
+                patch.object(DeclarePendingCommand, 'declare_batch', autospec=True, side_effect=failing_declare_batch):
+            command = self.declare(2)
+
+        self.assertEqual(command.declared, 5)
+        self.assertEqual(
+            sorted(int(batch[0]) for batch in self.sent_batches),
+            self.tax_receipt_ids[5:]
+        )
+
+    def test_declare_workers_connections(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_control.Client.side_effect = self.billing_client
+        threads = []
+
+        with patch(
+            'invoicing_app.management.commands.declare_pending_tax_receipts.close_old_connections',
+            side_effect=lambda: threads.append(threading.current_thread()),
+        ):
+            self.declare(3)
+
+        # Before each of the 4 pages and the empty one, in the thread reading them
+        self.assertEqual(threads, [threading.current_thread()] * 5)
+
+    def test_pending_batches(self, patch_control, patch_statuses, patch_token, patch_permission):
+        TaxReceiptsFactory.create(user_id=1, event_id=11, status_id=2)
+        command = DeclarePendingCommand()
+
+        batches = command.pending_batches({'status_id': 1})
+        first_batch = next(batches)
+        # Receipts created after a page was read are still found by the next pages
+        late_id = TaxReceiptsFactory.create(user_id=1, event_id=12, status_id=1).id
+
+        self.assertEqual(
+            [first_batch] + list(batches),
+            [self.tax_receipt_ids[0:3], self.tax_receipt_ids[3:6], self.tax_receipt_ids[6:9],
+             [self.tax_receipt_ids[9], late_id]]
+        )
+
+    def test_declare_after_id(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_control.Client.side_effect = self.billing_client
+        command = DeclarePendingCommand()
+        command.dry_run = False
+        command.after_id = self.tax_receipt_ids[5]
+
+        command.declare_pending_tax_receipts()
+
+        self.assertEqual(
+            self.sent_batches,
+            [[str(tax_receipt_id) for tax_receipt_id in self.tax_receipt_ids[6:9]], [str(self.tax_receipt_ids[9])]]
+        )
+        self.assertEqual(command.declared, 4)
+
+    def test_declare_transient_error(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        client = Mock()
+        client.send_job.side_effect = [Exception('timeout'), Mock(is_error=Mock(return_value=False))] + [
+            Mock(is_error=Mock(return_value=False))
+        ] * 3
+        patch_control.Client.return_value = client
+
+        command = self.declare(1)
+
+        self.assertEqual(client.send_job.call_count, 5)
+        self.assertEqual((command.declared, command.failed, command.failed_batches), (10, 0, 0))
+        self.assertFalse(os.path.exists(self.failed_file))
+
+    def test_declare_billing_unavailable(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_control.Client.return_value.send_job.side_effect = Exception('timeout')
+
+        for workers in (1, 2):
+            patch_control.Client.return_value.send_job.reset_mock()
+            command = self.declare(workers)
+
+            # Only the attempts of the first batches, none of their ids is split or failed
+            self.assertLessEqual(patch_control.Client.return_value.send_job.call_count, 3 * workers)
+            self.assertEqual((command.declared, command.failed), (0, 0))
+            self.assertFalse(os.path.exists(self.failed_file))
+            self.assertIsNone(command.journal.get(*command.get_journal_key()))
+
+    def test_declare_rejected_halves(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        client = patch_control.Client.return_value
+        client.send_job.return_value = Mock(
+            is_error=Mock(return_value=True),
+            pretty_error=Mock(return_value='SERVICE_UNAVAILABLE'),
+            actions=[],
+        )
+
+        command = self.declare(1)
+
+        # The batch and both of its halves, then the run stops
+        self.assertEqual(client.send_job.call_count, 3 * 3)
+        self.assertEqual((command.declared, command.failed), (0, 0))
+        self.assertFalse(os.path.exists(self.failed_file))
+        self.assertIsNone(command.tracker.last_event_id)
+
+    def test_declare_auth_error(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_token.side_effect = lambda permission: 'token-{}'.format(patch_token.call_count)
+        client = Mock()
+        rejected = Mock(
+            is_error=Mock(return_value=True),
+            pretty_error=Mock(return_value='UNAUTHORIZED'),
+            actions=[],
+        )
+        client.send_job.side_effect = [rejected] + [Mock(is_error=Mock(return_value=False))] * 4
+        patch_control.Client.return_value = client
+
+        command = self.declare(1)
+
+        self.assertEqual(patch_token.call_count, 2)
+        self.assertEqual(client.new_job.return_value.control.auth, 'token-2')
+        self.assertEqual((command.declared, command.failed), (10, 0))
+
+    def test_declare_adaptive_batch(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_control.Client.side_effect = self.billing_client
+        self.failed_id = None
+        command = DeclarePendingCommand()
+        command.dry_run = False
+        command.adaptive_batch = True
+
+        with patch.object(settings, 'TAX_RECEIPTS_BATCH_TO_DECLARE_MIN', 1, create=True), \
+                patch.object(settings, 'TAX_RECEIPTS_BATCH_TO_DECLARE_MAX', 6, create=True), \
+                patch.object(settings, 'TAX_RECEIPTS_DECLARE_TARGET_LATENCY', 1, create=True):
+            command.declare_pending_tax_receipts()
+
+        self.assertEqual([len(batch) for batch in self.sent_batches], [3, 4, 3])
+        self.assertEqual(command.batch_sizer.sizes, [3, 4, 5])
+        self.assertEqual(command.declared, 10)
+
+    def adaptive_declare(self):
+        command = DeclarePendingCommand()
+        command.dry_run = False
+        command.adaptive_batch = True
+        with patch.object(settings, 'TAX_RECEIPTS_BATCH_TO_DECLARE_MIN', 1, create=True), \
+                patch.object(settings, 'TAX_RECEIPTS_BATCH_TO_DECLARE_MAX', 6, create=True), \
+                patch.object(settings, 'TAX_RECEIPTS_DECLARE_TARGET_LATENCY', 1, create=True):
+            command.declare_pending_tax_receipts()
+        return command
+
+    def test_declare_adaptive_batch_bad_id(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_control.Client.side_effect = self.billing_client
+
+        command = self.adaptive_declare()
+
+        # The retries and splits of the batch with the failing id don't shrink the size
+        self.assertEqual(command.batch_sizer.sizes, [3, 4])
+        self.assertEqual((command.declared, command.failed), (9, 1))
+
+    def test_declare_adaptive_batch_job_error(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        client = Mock()
+        client.send_job.side_effect = [Exception('timeout')] + [Mock(is_error=Mock(return_value=False))] * 10
+        patch_control.Client.return_value = client
+
+        command = self.adaptive_declare()
+
+        self.assertEqual(command.batch_sizer.sizes[:2], [3, 1])
+        self.assertEqual(command.declared, 10)
+
+    def test_journal(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_control.Client.side_effect = self.billing_client
+
+        command = self.declare(3)
+
+        self.assertEqual(
+            command.journal.get(*command.get_journal_key()),
+            {'last_id': self.tax_receipt_ids[-1], 'batches': [], 'completed': True}
+        )
+
+    def test_resume(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        self.failed_id = None
+        crash_id = str(self.tax_receipt_ids[6])
+        billing_client = self.billing_client
+
+        def crashing_client(service):
+            client = billing_client(service)
+            send_job = client.send_job.side_effect
+
+            def send_or_crash(job):
+                if crash_id in job.declare_tax_receipts.call_args[1]['tax_receipt_ids']:
+                    raise KeyboardInterrupt()
+                return send_job(job)
+            client.send_job.side_effect = send_or_crash
+            return client
+
+        patch_control.Client.side_effect = crashing_client
+        with self.assertRaises(KeyboardInterrupt):
+            self.declare(1)
+        patch_control.Client.side_effect = self.billing_client
+        self.sent_batches = []
+
+        command = DeclarePendingCommand()
+        command.dry_run = False
+        command.resume = True
+        command.declare_pending_tax_receipts()
+
+        self.assertEqual(
+            self.sent_batches,
+            [[str(tax_receipt_id) for tax_receipt_id in self.tax_receipt_ids[6:9]], [str(self.tax_receipt_ids[9])]]
+        )
+        self.assertEqual(command.declared, 4)
+
+    def test_resume_skips_accepted_batches(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_control.Client.side_effect = self.billing_client
+        self.failed_id = None
+        command = DeclarePendingCommand()
+        command.dry_run = False
+        command.resume = True
+        command.journal.set(
+            {
+                'last_id': self.tax_receipt_ids[2],
+                'batches': [[self.tax_receipt_ids[6], self.tax_receipt_ids[8]]],
+                'completed': False,
+            },
+            *command.get_journal_key()
+        )
+
+        command.declare_pending_tax_receipts()
+
+        self.assertEqual(
+            self.sent_batches,
+            [[str(tax_receipt_id) for tax_receipt_id in self.tax_receipt_ids[3:6]], [str(self.tax_receipt_ids[9])]]
+        )
+        self.assertEqual(
+            command.journal.get(*command.get_journal_key()),
+            {'last_id': self.tax_receipt_ids[9], 'batches': [], 'completed': True}
+        )
+
+    def test_retry_failed(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_control.Client.side_effect = self.billing_client
+        self.declare(1)
+        self.failed_id = None
+        self.sent_batches = []
+
+        command = DeclarePendingCommand()
+        command.dry_run = False
+        command.retry_failed = True
+        command.declare_pending_tax_receipts()
+
+        self.assertEqual(self.sent_batches, [[str(self.tax_receipt_ids[4])]])
+        self.assertEqual((command.declared, command.failed), (1, 0))
+        self.assertEqual(os.path.getsize(self.failed_file), 0)
+
+    def test_retry_failed_crash(self, patch_control, patch_statuses, patch_token, patch_permission):
+        patch_statuses.get_id_from_name.return_value = 1
+        patch_control.Client.side_effect = self.billing_client
+        self.declare(1)
+        patch_control.Client.side_effect = None
+        patch_control.Client.return_value.send_job.side_effect = KeyboardInterrupt()
+
+        command = DeclarePendingCommand()
+        command.dry_run = False
+        command.retry_failed = True
+        with self.assertRaises(KeyboardInterrupt):
+            command.declare_pending_tax_receipts()
+
+        # The ids to retry are still there for the next --retry_failed
+        self.assertEqual(command.read_failed_ids(), [self.tax_receipt_ids[4]])
+
+
 class TestUpdateTaxReceipts(TestCase):
     def setUp(self):
         self.command = UpdateIncompleteCommand()
@@ -988,6 +1874,20 @@ class TestTaxReceiptGeneratorRequest(TestCase):
         self.assertEqual(my_request.event_id, 456)
         self.assertEqual(my_request.today_date, '2020-05-11')
 
+    def test_multi_country(self):
+        my_request = TaxReceiptGeneratorRequest(country='AR,BR', today_date='2020-04-01', user_id=None, event_id=None)
+        self.assertEqual(my_request.countries, ['AR', 'BR'])
+        self.assertEqual(
+            TaxReceiptGeneratorRequest(country=['BR'], today_date=None, user_id=None, event_id=None).countries,
+            ['BR']
+        )
+        self.assertEqual(
+            TaxReceiptGeneratorRequest(country='BR, AR,BR', today_date=None, user_id=None, event_id=None).countries,
+            ['AR', 'BR']
+        )
+        with self.assertRaises(CountryNotConfiguredException):
+            TaxReceiptGeneratorRequest(country='AR,CL', today_date=None, user_id=None, event_id=None)
+
     @patch.object(
         TaxReceiptGeneratorRequest, '_post_validate'
     )
@@ -1038,6 +1938,17 @@ class TestTaxReceiptGeneratorRequest(TestCase):
         self.assertEqual(my_request.today.month, dt.today().month)
         self.assertEqual(my_request.today.day, dt.today().day)
 
+    @patch.object(
+        TaxReceiptGeneratorRequest, '_post_validate'
+    )
+    def test_invalid_shard(self, patch_post):
+        with self.assertRaises(InvalidShardException):
+            TaxReceiptGeneratorRequest(
+                country='AR', today_date=None, user_id=None, event_id=None, shards=2, shard_index=2
+            )
+        with self.assertRaises(InvalidShardException):
+            TaxReceiptGeneratorRequest(country='AR', today_date=None, user_id=None, event_id=None, shards=0)
+
     @patch.object(
         TaxReceiptGeneratorRequest, '_post_validate'
     )
@@ -1062,6 +1973,13 @@ class TestTaxReceiptsGenerator(TestCase):
     """
 
     def setUp(self):
+        checkpoint_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, checkpoint_dir)
+        checkpoint_patcher = patch.object(
+            settings, 'TAX_RECEIPTS_CHECKPOINT_FILE', os.path.join(checkpoint_dir, 'checkpoints.json')
+        )
+        checkpoint_patcher.start()
+        self.addCleanup(checkpoint_patcher.stop)
         self.my_generator = TaxReceiptGenerator(dry_run=True, do_logging=False)
 
     def test_init(self):
@@ -1081,6 +1999,95 @@ class TestTaxReceiptsGenerator(TestCase):
         self.assertTrue(patch_childs.called)
         self.assertTrue(patch_no_series.called)
 
+    @patch.object(
+        TaxReceiptGenerator, 'get_and_iterate_all_events'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'get_and_iterate_no_series_events'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'get_and_iterate_child_events'
+    )
+    def test_run_calls_single_scan(self, patch_childs, patch_no_series, patch_all):
+        my_request = TaxReceiptGeneratorRequest(country='AR', today_date=None, user_id=None, event_id=None)
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False, single_scan=True)
+        generator.run(my_request)
+        self.assertTrue(patch_all.called)
+        self.assertFalse(patch_childs.called)
+        self.assertFalse(patch_no_series.called)
+
+    def test_single_scan_parity(self):
+        my_user = UserFactory.create()
+        my_event = EventFactory.create(user=my_user)
+        PaymentOptionsFactory.create(event=my_event)
+        OrderFactory.create(event=my_event)
+
+        my_parent = EventFactory.build(user=my_user, event_name='PARENT')
+        my_parent.series = True
+        my_parent.save()
+        PaymentOptionsFactory.create(event=my_parent)
+        for name in ('CHILD_1', 'CHILD_2'):
+            my_child = EventFactory.create(user=my_user, event_parent=my_parent, event_name=name)
+            OrderFactory.create(event=my_child)
+            OrderFactory.create(event=my_child, gross=2.2)
+
+        # Children with their own payment options whose parent has none accepting in the country
+        for parent_name, parent_country in (('NO_OPTIONS', None), ('OTHER_COUNTRY', 'BR')):
+            other_parent = EventFactory.build(user=my_user, event_name=parent_name)
+            other_parent.series = True
+            other_parent.save()
+            if parent_country:
+                PaymentOptionsFactory.create(event=other_parent, epp_country=parent_country)
+            own_options_child = EventFactory.create(
+                user=my_user,
+                event_parent=other_parent,
+                event_name='CHILD_OF_{}'.format(parent_name)[:20],
+            )
+            PaymentOptionsFactory.create(event=own_options_child)
+            OrderFactory.create(event=own_options_child)
+
+        query_options_test = {
+            'localize_end_date_query': '2020-04-01',
+            'localize_start_date_query': '2020-03-01',
+            'declarable_tax_receipt_countries_query': 'AR',
+            'status_query': 100,
+        }
+        two_queries_results = []
+        for mask in ('(`Events`.`id` = `Payment_Options`.`event`)',
+                     '(`Events`.`event_parent` = `Payment_Options`.`event`)'):
+            query = self.my_generator.query.format(condition_mask='', parent_child_mask=mask)
+            two_queries_results.extend(self.my_generator.get_query_results(query_options_test, query))
+
+        with patch.object(TaxReceiptGenerator, 'iterate_querys_results') as patch_iterate:
+            self.my_generator.get_and_iterate_all_events(query_options_test)
+        single_scan_results = patch_iterate.call_args[0][0]
+
+        expected_len = 5
+        self.assertEqual(len(single_scan_results), expected_len)
+        self.assertEqual(
+            sorted(single_scan_results, key=lambda result: result.event_id),
+            sorted(two_queries_results, key=lambda result: result.event_id)
+        )
+
+    def test_single_scan_multi_country(self):
+        my_user = UserFactory.create()
+        for country in ('AR', 'BR'):
+            my_parent = EventFactory.build(user=my_user, event_name='PARENT_{}'.format(country))
+            my_parent.series = True
+            my_parent.save()
+            PaymentOptionsFactory.create(event=my_parent, epp_country=country)
+            my_child = EventFactory.create(user=my_user, event_parent=my_parent, event_name='CHILD_{}'.format(country))
+            OrderFactory.create(event=my_child)
+        request = TaxReceiptGeneratorRequest(country='AR,BR', today_date='2020-04-01', user_id=None, event_id=None)
+        two_phases_generator = TaxReceiptGenerator(dry_run=True, do_logging=False)
+        single_scan_generator = TaxReceiptGenerator(dry_run=True, do_logging=False, single_scan=True)
+
+        two_phases_generator.run(request)
+        single_scan_generator.run(request)
+
+        self.assertEqual(len(two_phases_generator.output_dict), 2)
+        self.assertEqual(single_scan_generator.output_dict, two_phases_generator.output_dict)
+
     def test_run_w_user(self):
         my_request = TaxReceiptGeneratorRequest(country='AR', today_date=None, user_id=1, event_id=None)
         self.my_generator.run(my_request)
@@ -1091,6 +2098,73 @@ class TestTaxReceiptsGenerator(TestCase):
         self.my_generator.run(my_request)
         self.assertEqual(self.my_generator.conditional_mask, 'AND `Events`.`id` = 1')
 
+    def test_run_w_shard(self):
+        my_request = TaxReceiptGeneratorRequest(
+            country='AR', today_date='2020-04-11', user_id=1, event_id=None, shards=4, shard_index=2
+        )
+        self.my_generator.run(my_request)
+        self.assertEqual(
+            self.my_generator.conditional_mask,
+            'AND `Events`.`uid` = 1 AND MOD(`Events`.`id`, 4) = 2'
+        )
+        self.assertEqual(self.my_generator.checkpoint_key, ('AR', '2020-03', 'user-1', 'shard-2-of-4'))
+        self.assertEqual(
+            self.my_generator.checkpoint_store.path,
+            shard_path(settings.TAX_RECEIPTS_CHECKPOINT_FILE, 2)
+        )
+
+    @patch(
+        'invoicing_app.tax_receipt_generator.connections'
+    )
+    def test_run_shards(self, patch_connections):
+        def run_shard(generator, request):
+            generator.cont_tax_receipts = request.shard_index + 1
+            generator.error_cont = 1
+
+        my_request = TaxReceiptGeneratorRequest(
+            country='AR', today_date=None, user_id=None, event_id=None, shards=3
+        )
+        with patch.object(TaxReceiptGenerator, 'run', autospec=True, side_effect=run_shard):
+            generator = run_shards(my_request, {'dry_run': True, 'do_logging': False})
+
+        self.assertTrue(patch_connections.close_all.called)
+        self.assertEqual(generator.cont_tax_receipts, 1 + 2 + 3)
+        self.assertEqual(generator.error_cont, 3)
+
+    @patch(
+        'invoicing_app.tax_receipt_generator.SHARD_RESULT_TIMEOUT', 0.1
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.connections'
+    )
+    def test_run_shards_killed_shard(self, patch_connections):
+        def run_shard(generator, request):
+            if request.shard_index == 1:
+                # Killed before reporting its results
+                os._exit(9)
+            generator.cont_tax_receipts = 1
+
+        my_request = TaxReceiptGeneratorRequest(
+            country='AR', today_date=None, user_id=None, event_id=None, shards=3
+        )
+        with patch.object(TaxReceiptGenerator, 'run', autospec=True, side_effect=run_shard):
+            generator = run_shards(my_request, {'dry_run': True, 'do_logging': False})
+
+        self.assertEqual(generator.cont_tax_receipts, 2)
+        self.assertEqual(generator.error_cont, 1)
+
+    def test_save_checkpoint_error(self):
+        generator = TaxReceiptGenerator(dry_run=False, do_logging=False)
+        generator.checkpoint_key = ('AR', '2020-03')
+        generator.checkpoint_phase = PHASE_CHILD
+        generator.checkpoint_tracker.start(1)
+        generator.checkpoint_tracker.finish(1)
+
+        with patch.object(generator.checkpoint_store, 'set', side_effect=ValueError('No JSON object')):
+            generator.save_checkpoint()
+
+        self.assertEqual(generator.error_cont, 0)
+
     def test_logging(self):
         my_generator_other = TaxReceiptGenerator(dry_run=True, do_logging=True)
         name_expected = 'financial_transactions'
@@ -1207,8 +2281,29 @@ class TestTaxReceiptsGenerator(TestCase):
             list
         )
 
+    def test_get_query_results_stream(self):
+        my_user = UserFactory.create()
+        my_event = EventFactory.create(user=my_user)
+        PaymentOptionsFactory.create(event=my_event)
+        OrderFactory.create(event=my_event)
+        query_options_test = {
+            'localize_end_date_query': '2020-04-01',
+            'localize_start_date_query': '2020-03-01',
+            'declarable_tax_receipt_countries_query': 'AR',
+            'status_query': 100,
+        }
+        parent_mask = '(`Events`.`id` = `Payment_Options`.`event`)'
+        query_to_send = self.my_generator.query.format(condition_mask='', parent_child_mask=parent_mask)
+        expected_results = self.my_generator.get_query_results(query_options_test, query_to_send)
+
+        stream_generator = TaxReceiptGenerator(dry_run=True, do_logging=False, stream_results=True)
+        results = stream_generator.get_query_results(query_options_test, query_to_send)
+
+        self.assertIsInstance(results, types.GeneratorType)
+        self.assertEqual(list(results), expected_results)
+
     @patch.object(
-        TaxReceiptGenerator, 'generate_tax_receipts'
+        TaxReceiptGenerator, 'generate_tax_receipt_from_row'
     )
     def test_iterate_querys_results(self, patch_generate):
         my_user = UserFactory.create()
@@ -1234,21 +2329,606 @@ class TestTaxReceiptsGenerator(TestCase):
             query_options_test['localize_start_date_query'],
             query_options_test['localize_end_date_query']
         )
-        expected_len_payment_option = 8
-        expected_len_event = 3
-        expected_len_tax_receipt_orders = 4
+        row = patch_generate.call_args[0][0]
+        self.assertIsInstance(row, GenerationRow)
+        self.assertEqual(row.event_id, my_event.id)
+        self.assertEqual(row.user_id, my_user.id)
+        self.assertEqual(row.epp_country, my_pay_opt.epp_country)
+        self.assertEqual(row.payment_transactions_count, 1)
+
+        self.assertEqual(patch_generate.call_args[0][1], query_options_test['localize_start_date_query'])
+        self.assertEqual(patch_generate.call_args[0][2], query_options_test['localize_end_date_query'])
 
-        self.assertEqual(len(patch_generate.call_args[0][0]), expected_len_payment_option)
-        self.assertIsInstance(patch_generate.call_args[0][0], dict)
+    def test_generation_row_smaller_than_dict(self):
+        row = build_generation_result(1)
+        self.assertLess(sys.getsizeof(row), sys.getsizeof(dict(row._asdict())))
 
-        self.assertEqual(len(patch_generate.call_args[0][1]), expected_len_event)
-        self.assertIsInstance(patch_generate.call_args[0][1], dict)
+    def test_dispatch_concurrently(self):
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False, workers=4)
+        # Events not in EVENTBRITE_TAX_INFORMATION fail and are logged
+        results = [
+            build_generation_result(event_id, epp_country='CL' if event_id % 5 == 0 else 'AR')
+            for event_id in range(1, 21)
+        ]
 
-        self.assertEqual(patch_generate.call_args[0][2], query_options_test['localize_start_date_query'])
-        self.assertEqual(patch_generate.call_args[0][3], query_options_test['localize_end_date_query'])
+        generator.iterate_querys_results(iter(results), dt(2020, 3, 1, 0, 0), dt(2020, 4, 1, 0, 0))
 
-        self.assertEqual(len(patch_generate.call_args[0][4]), expected_len_tax_receipt_orders)
-        self.assertIsInstance(patch_generate.call_args[0][4], dict)
+        expected_generated = 16
+        expected_errors = 4
+        self.assertEqual(generator.cont_tax_receipts, expected_generated)
+        self.assertEqual(generator.error_cont, expected_errors)
+        self.assertEqual(len(generator.output_dict), expected_generated)
+
+    @patch(
+        'invoicing_app.tax_receipt_generator.PERMISSION_USER_PAYMENTS_USER_INSTRUMENTS', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.get_noninteractive_token', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.control', create=True
+    )
+    def test_send_tax_receipts_batch(self, patch_control, patch_token, patch_permission):
+        client = patch_control.Client.return_value
+        response = client.send_job.return_value
+        response.is_error.return_value = True
+        failed_action = Mock(error_detail='invalid recipient')
+        ok_action = Mock(error_detail=None)
+        response.actions = [ok_action, failed_action, ok_action]
+
+        generator = TaxReceiptGenerator(dry_run=False, do_logging=False)
+        generator.batch_size = 3
+        results = [build_generation_result(event_id) for event_id in range(1, 7)]
+        with patch.object(TaxReceiptGenerator, '_log_exception') as patch_log:
+            generator.iterate_querys_results(results, dt(2020, 3, 1, 0, 0), dt(2020, 4, 1, 0, 0))
+
+        expected_jobs = 2
+        expected_actions = 6
+        self.assertEqual(client.send_job.call_count, expected_jobs)
+        self.assertEqual(client.new_job.return_value.create_tax_receipt.call_count, expected_actions)
+        # 1 failed action in each batch
+        self.assertEqual(generator.cont_tax_receipts, 4)
+        self.assertEqual([call[0][1] for call in patch_log.call_args_list], [2, 5])
+
+    @patch(
+        'invoicing_app.tax_receipt_generator.PERMISSION_USER_PAYMENTS_USER_INSTRUMENTS', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.get_noninteractive_token', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.control', create=True
+    )
+    def test_send_tax_receipts_batch_job_error(self, patch_control, patch_token, patch_permission):
+        client = patch_control.Client.return_value
+        response = client.send_job.return_value
+        response.pretty_error.return_value = 'unavailable'
+        generator = TaxReceiptGenerator(dry_run=False, do_logging=False)
+        batch = [(event_id, {}, None) for event_id in range(1, 4)]
+
+        for is_error, actions in (
+            # Fewer actions than events
+            (True, [Mock(error_detail='unavailable')]),
+            (False, [Mock(error_detail=None)]),
+            # Job error without the detail of any action
+            (True, [Mock(error_detail=None)] * 3),
+        ):
+            response.is_error.return_value = is_error
+            response.actions = actions
+            generator.checkpoint_tracker = CheckpointTracker()
+            for event_id, orders_kwargs, read_at in batch:
+                generator.checkpoint_tracker.start(event_id)
+            with patch.object(TaxReceiptGenerator, '_log_exception', wraps=generator._log_exception) as patch_log:
+                generator.send_tax_receipts_batch(batch)
+
+            self.assertEqual([call[0][1] for call in patch_log.call_args_list], [1, 2, 3])
+            self.assertEqual(generator.checkpoint_tracker.last_event_id, 3)
+        self.assertEqual(generator.cont_tax_receipts, 0)
+        self.assertEqual(generator.error_cont, 9)
+
+    @patch(
+        'invoicing_app.tax_receipt_generator.PERMISSION_USER_PAYMENTS_USER_INSTRUMENTS', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.get_noninteractive_token', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.control', create=True
+    )
+    def test_send_tax_receipts_batch_auth_error(self, patch_control, patch_token, patch_permission):
+        client = patch_control.Client.return_value
+        rejected = Mock(
+            is_error=Mock(return_value=True),
+            pretty_error=Mock(return_value='TOKEN_EXPIRED'),
+            actions=[Mock(error_detail='TOKEN_EXPIRED')],
+        )
+        client.send_job.side_effect = [rejected, Mock(is_error=Mock(return_value=False), actions=[Mock()])]
+        generator = TaxReceiptGenerator(dry_run=False, do_logging=False)
+
+        generator.send_tax_receipts_batch([(1, {}, None)])
+        generator.send_tax_receipts_batch([(2, {}, None)])
+
+        # The rejected token is not used by the next batch
+        self.assertEqual(patch_token.call_count, 2)
+        self.assertEqual((generator.cont_tax_receipts, generator.error_cont), (1, 1))
+
+    @patch(
+        'invoicing_app.tax_receipt_generator.PERMISSION_USER_PAYMENTS_USER_INSTRUMENTS', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.get_noninteractive_token', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.control', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.default_timer'
+    )
+    def test_event_latency(self, patch_timer, patch_control, patch_token, patch_permission):
+        """The latency of each event goes from its read to the answer of its batch"""
+        response = patch_control.Client.return_value.send_job.return_value
+        response.is_error.return_value = False
+        response.actions = [Mock()] * 3
+        # Three rows read at 0, 1 and 2 seconds, their batch answered at 10
+        patch_timer.side_effect = [0, 1, 2, 10, 10, 10]
+        generator = TaxReceiptGenerator(dry_run=False, do_logging=False)
+        generator.batch_size = 3
+        results = [build_generation_result(event_id) for event_id in range(1, 4)]
+
+        generator.iterate_querys_results(results, dt(2020, 3, 1, 0, 0), dt(2020, 4, 1, 0, 0))
+
+        histogram = generator.metrics.summary()['histograms']['event']
+        self.assertEqual(histogram['count'], 3)
+        self.assertEqual(histogram['max'], 10)
+        self.assertEqual(histogram['mean'], 9)
+
+    @patch(
+        'invoicing_app.tax_receipt_generator.PERMISSION_USER_PAYMENTS_USER_INSTRUMENTS', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.get_noninteractive_token', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.control', create=True
+    )
+    def test_billing_client_reused(self, patch_control, patch_token, patch_permission):
+        """Every job is sent through the clients opened for the workers"""
+        class BillingStub(object):
+            def __init__(self, service):
+                self.closed = False
+                self.jobs = 0
+
+            def new_job(self):
+                return Mock()
+
+            def send_job(self, job):
+                self.jobs += 1
+                return Mock(is_error=Mock(return_value=False), actions=[Mock()])
+
+            def close(self):
+                self.closed = True
+
+        patch_control.Client = Mock(side_effect=BillingStub)
+        generator = TaxReceiptGenerator(dry_run=False, do_logging=False, workers=2)
+        generator.batch_size = 1
+        calls = 20
+        results = [build_generation_result(event_id) for event_id in range(1, calls + 1)]
+
+        generator.iterate_querys_results(results, dt(2020, 3, 1, 0, 0), dt(2020, 4, 1, 0, 0))
+        clients = list(generator._billing_clients.queue)
+        generator.close_billing_clients()
+
+        self.assertEqual(generator.cont_tax_receipts, calls)
+        self.assertLessEqual(patch_control.Client.call_count, generator.workers)
+        self.assertEqual(len(clients), patch_control.Client.call_count)
+        self.assertEqual(sum(client.jobs for client in clients), calls)
+        self.assertTrue(all(client.closed for client in clients))
+
+    @patch(
+        'invoicing_app.tax_receipt_generator.PERMISSION_USER_PAYMENTS_USER_INSTRUMENTS', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.get_noninteractive_token', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.control', create=True
+    )
+    def test_max_in_flight(self, patch_control, patch_token, patch_permission):
+        """Batches are sent while the results are still read, never more than max_in_flight at once"""
+        in_flight = {'current': 0, 'max': 0}
+        in_flight_lock = threading.Lock()
+        overlapped = threading.Event()
+
+        class BillingStub(object):
+            def __init__(self, service):
+                pass
+
+            def new_job(self):
+                return Mock()
+
+            def send_job(self, job):
+                with in_flight_lock:
+                    in_flight['current'] += 1
+                    in_flight['max'] = max(in_flight['max'], in_flight['current'])
+                    if in_flight['current'] > 1:
+                        overlapped.set()
+                # The first job is only answered once the next one was read and sent
+                overlapped.wait(5)
+                with in_flight_lock:
+                    in_flight['current'] -= 1
+                return Mock(is_error=Mock(return_value=False), actions=[Mock()])
+
+        def generate(max_in_flight):
+            generator = TaxReceiptGenerator(dry_run=False, do_logging=False, max_in_flight=max_in_flight)
+            generator.batch_size = 1
+            generator.start_dispatcher()
+            results = (build_generation_result(event_id) for event_id in range(1, 21))
+            generator.iterate_querys_results(results, dt(2020, 3, 1, 0, 0), dt(2020, 4, 1, 0, 0))
+            generator.stop_dispatcher()
+            return generator
+
+        patch_control.Client = Mock(side_effect=BillingStub)
+        pipeline_generator = generate(2)
+
+        self.assertTrue(overlapped.is_set())
+        self.assertEqual(in_flight['max'], 2)
+        self.assertEqual(pipeline_generator.cont_tax_receipts, 20)
+        self.assertEqual(pipeline_generator.checkpoint_tracker.last_event_id, 20)
+
+        # Without max_in_flight the batches are sent one at a time
+        in_flight['max'] = 0
+        serial_generator = generate(0)
+        self.assertEqual(in_flight['max'], 1)
+        self.assertEqual(serial_generator.cont_tax_receipts, 20)
+
+    @patch.object(
+        TaxReceiptGenerator, 'iterate_querys_results'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'get_query_results'
+    )
+    def test_resume(self, patch_query, patch_iterate):
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False, resume=True)
+        generator.checkpoint_key = ('AR', '2020-03')
+        generator.checkpoint_store.set({'last_event_id': 7, 'completed': False}, 'AR', '2020-03', 'no_series')
+        generator.checkpoint_store.set({'last_event_id': 9, 'completed': True}, 'AR', '2020-03', 'child')
+        query_options_test = {
+            'localize_end_date_query': '2020-04-01',
+            'localize_start_date_query': '2020-03-01',
+            'declarable_tax_receipt_countries_query': 'AR',
+            'status_query': 100,
+        }
+
+        generator.get_and_iterate_no_series_events(query_options_test)
+        generator.get_and_iterate_child_events(query_options_test)
+
+        self.assertEqual(patch_query.call_count, 1)
+        self.assertIn('AND `Events`.`id` > 7', patch_query.call_args[0][1])
+
+    @patch.object(
+        TaxReceiptGenerator, 'notify_end'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'notify_start'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'iterate_querys_results'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'localize_date', side_effect=lambda country, date: date
+    )
+    def test_resume_after_event_run(self, patch_localize, patch_iterate, patch_start, patch_end):
+        my_user = UserFactory.create()
+        my_event = EventFactory.create(user=my_user)
+        PaymentOptionsFactory.create(event=my_event)
+        OrderFactory.create(event=my_event)
+        other_event = EventFactory.create(user=my_user, event_name='EVENT_2')
+        PaymentOptionsFactory.create(event=other_event)
+        OrderFactory.create(event=other_event)
+        generated_events = []
+        patch_iterate.side_effect = lambda results, start, end: generated_events.extend(
+            result.event_id for result in results
+        )
+
+        event_request = TaxReceiptGeneratorRequest(
+            country='AR', today_date='2020-04-01', user_id=None, event_id=my_event.id
+        )
+        TaxReceiptGenerator(dry_run=False, do_logging=False).run(event_request)
+        self.assertEqual(generated_events, [my_event.id])
+
+        # The phases completed by the event run are not completed for the whole country
+        generated_events[:] = []
+        request = TaxReceiptGeneratorRequest(country='AR', today_date='2020-04-01', user_id=None, event_id=None)
+        TaxReceiptGenerator(dry_run=False, do_logging=False, resume=True).run(request)
+        self.assertEqual(sorted(generated_events), sorted([my_event.id, other_event.id]))
+
+    def test_console_handler_once(self):
+        for _ in range(3):
+            TaxReceiptGenerator(dry_run=True, do_logging=True)
+        handlers = logging.getLogger(NAME_LOGGING).handlers
+        self.assertEqual(len([handler for handler in handlers if getattr(handler, 'generation_console', False)]), 1)
+
+    def test_log_every(self):
+        results = [build_generation_result(event_id) for event_id in range(1, 8)]
+        start_date = dt(2020, 3, 1, 3, 0)
+        end_date = dt(2020, 4, 1, 3, 0)
+
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False, log_every=3)
+        generator.logger = logging.getLogger(NAME_LOGGING)
+        with patch.object(generator.logger, 'info') as patch_info:
+            generator.iterate_querys_results(results, start_date, end_date)
+        self.assertEqual([call[0][1] for call in patch_info.call_args_list], [1, 4, 7])
+        self.assertEqual(generator.cont_tax_receipts, 7)
+
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False, log_every=0)
+        generator.logger = logging.getLogger(NAME_LOGGING)
+        with patch.object(generator.logger, 'info') as patch_info:
+            generator.iterate_querys_results(results, start_date, end_date)
+        self.assertFalse(patch_info.called)
+
+    def test_log_event_disabled_level(self):
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False)
+        with patch.object(generator.logger, 'isEnabledFor', return_value=False):
+            self.assertFalse(generator.log_event())
+        with patch.object(generator.logger, 'isEnabledFor', return_value=True):
+            self.assertTrue(generator.log_event())
+
+    def test_multi_country_parity(self):
+        my_user = UserFactory.create()
+        ar_event = EventFactory.create(user=my_user)
+        PaymentOptionsFactory.create(event=ar_event)
+        br_event = EventFactory.create(user=my_user, event_name='BR_EVENT', currency='BRL')
+        PaymentOptionsFactory.create(event=br_event, epp_country='BR')
+        OrderFactory.create(event=ar_event)
+        OrderFactory.create(event=br_event)
+        # In the window of Brazil but before the start of the month in Argentina
+        boundary_date = str(dt(2020, 3, 1, 3, 0))
+        OrderFactory.create(event=ar_event, pp_date=boundary_date, changed=boundary_date, gross=2.2)
+        OrderFactory.create(event=br_event, pp_date=boundary_date, changed=boundary_date, gross=2.2)
+
+        single_results = {}
+        for country in ('AR', 'BR'):
+            generator = TaxReceiptGenerator(dry_run=True, do_logging=False)
+            generator.run(TaxReceiptGeneratorRequest(country=country, today_date='2020-04-01', user_id=None, event_id=None))
+            single_results.update(generator.output_dict)
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False)
+        with patch.object(generator, 'get_query_results', wraps=generator.get_query_results) as patch_query:
+            generator.run(TaxReceiptGeneratorRequest(country='AR,BR', today_date='2020-04-01', user_id=None, event_id=None))
+
+        self.assertEqual(patch_query.call_count, 2)
+        self.assertEqual(generator.output_dict, single_results)
+        self.assertEqual(single_results[str(ar_event.id)]['tax_receipt']['payment_transactions_count'], 1)
+        self.assertEqual(single_results[str(br_event.id)]['tax_receipt']['payment_transactions_count'], 2)
+
+    def test_country_list(self):
+        my_event = EventFactory.create(user=UserFactory.create())
+        PaymentOptionsFactory.create(event=my_event)
+        OrderFactory.create(event=my_event)
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False)
+
+        with patch.object(generator, 'get_query_results', wraps=generator.get_query_results) as patch_query:
+            generator.run(TaxReceiptGeneratorRequest(country=['AR'], today_date='2020-04-01', user_id=None, event_id=None))
+
+        self.assertEqual(patch_query.call_args[0][0]['declarable_tax_receipt_countries_query'], 'AR')
+        self.assertEqual(list(generator.output_dict), [str(my_event.id)])
+
+    @patch.object(
+        TaxReceiptGenerator, 'localize_date', side_effect=lambda country, date: date
+    )
+    def test_run_summary(self, patch_localize):
+        my_user = UserFactory.create()
+        my_event = EventFactory.create(user=my_user)
+        PaymentOptionsFactory.create(event=my_event)
+        OrderFactory.create(event=my_event)
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False)
+
+        generator.run(TaxReceiptGeneratorRequest(country='AR', today_date='2020-04-01', user_id=None, event_id=None))
+
+        summary = generator.run_summary
+        self.assertEqual(
+            set(summary['timers']),
+            {'localize_dates', 'no_series_query', 'no_series_iterate', 'child_query', 'child_iterate'}
+        )
+        self.assertEqual(summary['counters'], {'rows': 1, 'tax_receipts': 1, 'errors': 0})
+        self.assertEqual(summary['histograms']['event']['count'], 1)
+        self.assertGreater(summary['rows_per_second'], 0)
+
+    @patch.object(
+        TaxReceiptGenerator, 'notify_end'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'notify_start'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'iterate_querys_results'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'localize_date', side_effect=lambda country, date: date
+    )
+    def test_incremental(self, patch_localize, patch_iterate, patch_start, patch_end):
+        my_user = UserFactory.create()
+        old_event = EventFactory.create(user=my_user)
+        PaymentOptionsFactory.create(event=old_event)
+        OrderFactory.create(event=old_event, changed=str(dt(2020, 3, 5, 0, 0)))
+        changed_event = EventFactory.create(user=my_user, event_name='EVENT_2')
+        PaymentOptionsFactory.create(event=changed_event)
+        OrderFactory.create(event=changed_event, changed=str(dt(2020, 3, 20, 0, 0)))
+        generated_events = []
+        patch_iterate.side_effect = lambda results, start, end: generated_events.extend(
+            result.event_id for result in results
+        )
+        request = TaxReceiptGeneratorRequest(country='AR', today_date='2020-04-01', user_id=None, event_id=None)
+
+        TaxReceiptGenerator(dry_run=False, do_logging=False, incremental=True).run(request)
+
+        self.assertEqual(sorted(generated_events), sorted([old_event.id, changed_event.id]))
+        watermark = CheckpointStore(settings.TAX_RECEIPTS_CHECKPOINT_FILE).get('AR', '2020-03', 'watermark')
+        self.assertTrue(watermark['changed'].startswith('2020-03-20 00:00:00'))
+
+        generated_events[:] = []
+        OrderFactory.create(event=old_event, changed=str(dt(2020, 3, 25, 0, 0)), gross=2.2)
+
+        TaxReceiptGenerator(dry_run=False, do_logging=False, incremental=True).run(request)
+
+        self.assertEqual(generated_events, [old_event.id])
+        watermark = CheckpointStore(settings.TAX_RECEIPTS_CHECKPOINT_FILE).get('AR', '2020-03', 'watermark')
+        self.assertTrue(watermark['changed'].startswith('2020-03-25 00:00:00'))
+
+    @patch.object(
+        TaxReceiptGenerator, 'notify_end'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'notify_start'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'iterate_querys_results'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'localize_date', side_effect=lambda country, date: date
+    )
+    def test_incremental_w_errors(self, patch_localize, patch_iterate, patch_start, patch_end):
+        my_event = EventFactory.create(user=UserFactory.create())
+        PaymentOptionsFactory.create(event=my_event)
+        OrderFactory.create(event=my_event)
+        generator = TaxReceiptGenerator(dry_run=False, do_logging=False, incremental=True)
+        patch_iterate.side_effect = lambda results, start, end: generator._log_exception(Exception('error'))
+
+        generator.run(TaxReceiptGeneratorRequest(country='AR', today_date='2020-04-01', user_id=None, event_id=None))
+
+        self.assertIsNone(generator.checkpoint_store.get('AR', '2020-03', 'watermark'))
+
+    @patch.object(
+        TaxReceiptGenerator, 'notify_end'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'notify_start'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'iterate_querys_results'
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'localize_date', side_effect=lambda country, date: date
+    )
+    def test_incremental_event_run(self, patch_localize, patch_iterate, patch_start, patch_end):
+        my_user = UserFactory.create()
+        my_event = EventFactory.create(user=my_user)
+        PaymentOptionsFactory.create(event=my_event)
+        OrderFactory.create(event=my_event, changed=str(dt(2020, 3, 5, 0, 0)))
+        other_event = EventFactory.create(user=my_user, event_name='EVENT_2')
+        PaymentOptionsFactory.create(event=other_event)
+        OrderFactory.create(event=other_event, changed=str(dt(2020, 3, 20, 0, 0)))
+        generated_events = []
+        patch_iterate.side_effect = lambda results, start, end: generated_events.extend(
+            result.event_id for result in results
+        )
+
+        event_request = TaxReceiptGeneratorRequest(
+            country='AR', today_date='2020-04-01', user_id=None, event_id=my_event.id
+        )
+        TaxReceiptGenerator(dry_run=False, do_logging=False, incremental=True).run(event_request)
+        self.assertEqual(generated_events, [my_event.id])
+
+        # The watermark of the event run doesn't hide the other changed events from the full run
+        generated_events[:] = []
+        request = TaxReceiptGeneratorRequest(country='AR', today_date='2020-04-01', user_id=None, event_id=None)
+        TaxReceiptGenerator(dry_run=False, do_logging=False, incremental=True).run(request)
+        self.assertEqual(sorted(generated_events), sorted([my_event.id, other_event.id]))
+
+    @patch(
+        'invoicing_app.tax_receipt_generator.PERMISSION_USER_PAYMENTS_USER_INSTRUMENTS', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.get_noninteractive_token', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.control', create=True
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'get_query_results'
+    )
+    def test_save_checkpoint(self, patch_query, patch_control, patch_token, patch_permission):
+        responses = [Mock(actions=[Mock(), Mock()]), Mock(actions=[Mock()])]
+        for response in responses:
+            response.is_error.return_value = False
+        patch_control.Client.return_value.send_job.side_effect = responses
+        patch_query.return_value = [build_generation_result(event_id) for event_id in (3, 5, 8)]
+        generator = TaxReceiptGenerator(dry_run=False, do_logging=False)
+        generator.batch_size = 2
+        generator.checkpoint_key = ('AR', '2020-03')
+        query_options_test = {
+            'localize_end_date_query': dt(2020, 4, 1, 0, 0),
+            'localize_start_date_query': dt(2020, 3, 1, 0, 0),
+            'declarable_tax_receipt_countries_query': 'AR',
+            'status_query': 100,
+        }
+
+        with patch.object(generator.checkpoint_store, 'set', wraps=generator.checkpoint_store.set) as patch_set:
+            generator.get_and_iterate_no_series_events(query_options_test)
+
+        self.assertEqual(
+            [call[0][0] for call in patch_set.call_args_list],
+            [
+                {'last_event_id': 5, 'failed_event_ids': [], 'completed': False},
+                {'last_event_id': 8, 'failed_event_ids': [], 'completed': False},
+                {'last_event_id': 8, 'failed_event_ids': [], 'completed': True},
+            ]
+        )
+        self.assertEqual(
+            generator.checkpoint_store.get('AR', '2020-03', 'no_series'),
+            {'last_event_id': 8, 'failed_event_ids': [], 'completed': True}
+        )
+
+    @patch(
+        'invoicing_app.tax_receipt_generator.PERMISSION_USER_PAYMENTS_USER_INSTRUMENTS', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.get_noninteractive_token', create=True
+    )
+    @patch(
+        'invoicing_app.tax_receipt_generator.control', create=True
+    )
+    @patch.object(
+        TaxReceiptGenerator, 'get_query_results'
+    )
+    def test_resume_failed_events(self, patch_query, patch_control, patch_token, patch_permission):
+        response = Mock(actions=[Mock()])
+        response.is_error.return_value = False
+        # Billing is down for the batch of event 5
+        patch_control.Client.return_value.send_job.side_effect = [response, Exception('billing is down'), response]
+        patch_query.return_value = [build_generation_result(event_id) for event_id in (3, 5, 8)]
+        generator = TaxReceiptGenerator(dry_run=False, do_logging=False, resume=True)
+        generator.batch_size = 1
+        generator.checkpoint_key = ('AR', '2020-03')
+        query_options_test = {
+            'localize_end_date_query': dt(2020, 4, 1, 0, 0),
+            'localize_start_date_query': dt(2020, 3, 1, 0, 0),
+            'declarable_tax_receipt_countries_query': 'AR',
+            'status_query': 100,
+        }
+
+        generator.get_and_iterate_no_series_events(query_options_test)
+
+        self.assertEqual(generator.error_cont, 1)
+        self.assertEqual(
+            generator.checkpoint_store.get('AR', '2020-03', 'no_series'),
+            {'last_event_id': 8, 'failed_event_ids': [5], 'completed': False}
+        )
+
+        # The resumed run only retries the failed event
+        patch_control.Client.return_value.send_job.side_effect = None
+        patch_control.Client.return_value.send_job.return_value = response
+        patch_query.return_value = [build_generation_result(5)]
+        resumed_generator = TaxReceiptGenerator(dry_run=False, do_logging=False, resume=True)
+        resumed_generator.checkpoint_key = ('AR', '2020-03')
+
+        resumed_generator.get_and_iterate_no_series_events(query_options_test)
+
+        self.assertIn('AND (`Events`.`id` > 8 OR `Events`.`id` IN (5))', patch_query.call_args[0][1])
+        self.assertEqual(resumed_generator.cont_tax_receipts, 1)
+        self.assertEqual(
+            resumed_generator.checkpoint_store.get('AR', '2020-03', 'no_series'),
+            {'last_event_id': 8, 'failed_event_ids': [], 'completed': True}
+        )
 
     @patch.object(
         TaxReceiptGenerator, 'call_service'
@@ -1282,6 +2962,120 @@ class TestTaxReceiptsGenerator(TestCase):
         expected_len_tax_receipt_orders = 27
         self.assertEqual(len(patch_service.call_args.args[0]['tax_receipt']), expected_len_tax_receipt_orders)
 
+    def test_build_tax_receipt_payload(self):
+        pay_opt = {
+            'epp_address1': 'address 1',
+            'epp_address2': 'address 2',
+            'epp_state': 'state',
+            'epp_name_on_account': 'name',
+            'epp_tax_identifier': '',
+            'epp_zip': '5500',
+            'epp_country': 'BR',
+            'epp_city': 'city'
+        }
+        event = {'currency': u'BRL', 'user_id': 1, 'id': 2}
+        tr_order = {
+            'payment_transactions_count': 3,
+            'total_tax_amount': Decimal('1.1'),
+            'base_amount': Decimal('10.5'),
+            'total_taxable_amount_with_tax_amount': Decimal('5.1')
+        }
+        eb_tax_info = settings.EVENTBRITE_TAX_INFORMATION['BR']
+        expected_payload = {
+            'tax_receipt': {
+                'user_id': '1',
+                'event_id': '2',
+                'reporting_country_code': 'BR',
+                'currency': 'BRL',
+                'base_amount': {'value': 1050, 'currency': 'BRL'},
+                'total_taxable_amount': {'value': 400, 'currency': 'BRL'},
+                'payment_transactions_count': 3,
+                'start_date_period': '2020-03-01T03:00:00Z',
+                'end_date_period': '2020-04-01T03:00:00Z',
+                'description': '',
+                'supplier_type': 'EVENTBRITE',
+                'supplier_name': eb_tax_info['supplier_name'],
+                'supplier_address': eb_tax_info['supplier_address'],
+                'supplier_address_2': eb_tax_info['supplier_address_2'],
+                'supplier_postal_code': eb_tax_info['supplier_postal_code'],
+                'supplier_city': eb_tax_info['supplier_city'],
+                'supplier_region': eb_tax_info['supplier_region'],
+                'supplier_tax_information': {
+                    'tax_identifier_type': 'CNPJ',
+                    'tax_identifier_country': 'BR',
+                    'tax_identifier_number': eb_tax_info['tax_identifier_number'],
+                },
+                'recipient_name': 'name',
+                'recipient_type': 'ORGANIZER',
+                'recipient_address': 'address 1',
+                'recipient_address_2': 'address 2',
+                'recipient_postal_code': '5500',
+                'recipient_city': 'city',
+                'recipient_region': 'state',
+                'tax_receipt_period_details': [{
+                    'reference_type': 'ORDER',
+                    'start_date': '2020-03-01T03:00:00Z',
+                    'end_date': '2020-04-01T03:00:00Z',
+                    'tax_rate': 0,
+                    'base_amount': {'value': 1050, 'currency': 'BRL'},
+                    'taxable_amount': {'value': 400, 'currency': 'BRL'},
+                }],
+            }
+        }
+
+        row = GenerationRow(
+            event_id=event['id'],
+            user_id=event['user_id'],
+            event_parent=None,
+            currency=event['currency'],
+            **dict(pay_opt, **tr_order)
+        )
+
+        payload = self.my_generator.build_tax_receipt_payload(
+            row,
+            dt(2020, 3, 1, 3, 0),
+            dt(2020, 4, 1, 3, 0)
+        )
+
+        self.assertEqual(payload, expected_payload)
+
+    def test_build_tax_receipt_payload_null_tax(self):
+        row = build_generation_result(1, total_tax_amount=None)
+        payload = self.my_generator.build_tax_receipt_payload(row, dt(2020, 3, 1, 3, 0), dt(2020, 4, 1, 3, 0))
+        self.assertEqual(payload['tax_receipt']['total_taxable_amount'], {'value': 510, 'currency': 'ARS'})
+
+    def test_payload_template_built_once(self):
+        """The supplier information and period dates are read once per run, not once per row"""
+        class CountingDatetime(dt):
+            strftime_calls = 0
+
+            def strftime(self, date_format):
+                CountingDatetime.strftime_calls += 1
+                return super(CountingDatetime, self).strftime(date_format)
+
+        class CountingTaxInformation(dict):
+            lookups = 0
+
+            def __getitem__(self, country):
+                CountingTaxInformation.lookups += 1
+                return super(CountingTaxInformation, self).__getitem__(country)
+
+        start_date = CountingDatetime(2020, 3, 1, 3, 0)
+        end_date = CountingDatetime(2020, 4, 1, 3, 0)
+        tax_information = CountingTaxInformation(settings.EVENTBRITE_TAX_INFORMATION)
+        rows = 100
+
+        with patch.object(settings, 'EVENTBRITE_TAX_INFORMATION', tax_information):
+            payloads = [
+                self.my_generator.build_tax_receipt_payload(build_generation_result(event_id), start_date, end_date)
+                for event_id in range(1, rows + 1)
+            ]
+
+        self.assertEqual(len(payloads), rows)
+        self.assertEqual(CountingTaxInformation.lookups, 1)
+        self.assertEqual(CountingDatetime.strftime_calls, 2)
+        self.assertEqual(payloads[-1]['tax_receipt']['start_date_period'], '2020-03-01T03:00:00Z')
+
     def test_get_epp_tax_identifier_type(self):
         ar = 'AR'
         ar_tax_id = 'CUIT'
@@ -1404,6 +3198,141 @@ class TestTaxReceiptsGenerator(TestCase):
         )
 
 
+class TestGenerationQueryIndexes(TestCase):
+    """
+        The generation query must be answered with the composite index of Orders
+        and the unique event key of Payment_Options
+    """
+
+    def setUp(self):
+        my_event = EventFactory.create(user=UserFactory.create())
+        PaymentOptionsFactory.create(event=my_event)
+        OrderFactory.create(event=my_event)
+        self.query_options = {
+            'localize_end_date_query': '2020-04-01',
+            'localize_start_date_query': '2020-03-01',
+            'declarable_tax_receipt_countries_query': 'AR',
+            'status_query': 100,
+        }
+        self.query = TaxReceiptGenerator(dry_run=True, do_logging=False).query.format(
+            condition_mask='',
+            parent_child_mask='(`Events`.`id` = `Payment_Options`.`event`)',
+        )
+
+    def get_composite_index(self, table, columns):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, table)
+        for name, constraint in constraints.items():
+            if constraint['index'] and constraint['columns'] == columns:
+                return name
+
+    def get_unique_index(self, table, columns):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, table)
+        for name, constraint in constraints.items():
+            if constraint['unique'] and not constraint['primary_key'] and constraint['columns'] == columns:
+                return name
+
+    def explain_indexes(self):
+        """
+            Index used to read each table of the query, None when the table is scanned
+        """
+        with connection.cursor() as cursor:
+            if connection.vendor == 'mysql':
+                cursor.execute('EXPLAIN ' + self.query, self.query_options)
+                columns = [col[0] for col in cursor.description]
+                rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                return {row['table']: row['key'] for row in rows}
+            cursor.execute('EXPLAIN QUERY PLAN ' + self.query, self.query_options)
+            indexes = {}
+            for row in cursor.fetchall():
+                detail = row[-1].split()
+                if detail[0] in ('SCAN', 'SEARCH'):
+                    detail = [word for word in detail if word != 'TABLE']
+                    # SEARCH <table> AS <alias> USING INDEX <index>
+                    table = detail[3] if detail[2] == 'AS' else detail[1]
+                    indexes[table] = detail[detail.index('INDEX') + 1] if 'INDEX' in detail else None
+            return indexes
+
+    def test_orders_index(self):
+        index = self.get_composite_index(
+            'Orders',
+            ['status', 'changed', 'pp_date', 'event', 'mg_fee', 'eb_tax', 'gross']
+        )
+        self.assertIsNotNone(index)
+        self.assertEqual(self.explain_indexes()['Orders'], index)
+
+    def test_payment_options_index(self):
+        # Driven from Orders, the join is a lookup by the unique event key
+        self.assertEqual(
+            self.explain_indexes()['Payment_Options'],
+            self.get_unique_index('Payment_Options', ['event'])
+        )
+
+    def test_single_scan_indexes(self):
+        generator = TaxReceiptGenerator(dry_run=True, do_logging=False)
+        self.query = generator.join_parent_payment_options(generator.query).format(
+            condition_mask='',
+            parent_child_mask=PARENT_CHILD_MASKS[PHASE_ALL],
+        )
+        unique_event = self.get_unique_index('Payment_Options', ['event'])
+
+        indexes = self.explain_indexes()
+
+        self.assertIsNotNone(unique_event)
+        self.assertEqual(indexes['Parent_Payment_Options'], unique_event)
+        self.assertEqual(indexes['Payment_Options'], unique_event)
+
+
+class TestGenerationBenchmark(TestCase):
+    def test_measure(self):
+        benchmark = GenerationBenchmark(500, orders_per_event=10, series_ratio=0.5, children_per_series=2)
+        benchmark.build_dataset()
+
+        result = benchmark.measure()
+
+        events_with_orders = Order.objects.values('event').distinct().count()
+        self.assertEqual(Order.objects.count(), 500)
+        self.assertEqual(result['rows'], events_with_orders)
+        self.assertEqual(result['tax_receipts'], events_with_orders)
+        for stage in ('query_time', 'payload_time', 'iteration_time', 'end_to_end_time'):
+            self.assertGreater(result[stage], 0)
+        for stage in ('rows_memory', 'dict_rows_memory', 'end_to_end_memory'):
+            self.assertGreaterEqual(result[stage], 0)
+
+    def test_command(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        output = os.path.join(output_dir, 'benchmark.json')
+
+        call_command('benchmark_generation', orders=[100], billing_jobs=10, output=output, stdout=StringIO())
+        call_command('benchmark_generation', orders=[100, 200], billing_jobs=10, output=output, stdout=StringIO())
+
+        with open(output) as output_file:
+            runs = json.load(output_file)['runs']
+        self.assertEqual([[result['orders'] for result in run['results']] for run in runs], [[100], [100, 200]])
+        self.assertEqual([run['billing']['billing_jobs'] for run in runs], [10, 10])
+        self.assertEqual(Order.objects.count(), 0)
+
+    def test_billing_stub(self):
+        stub = BillingStub()
+        self.addCleanup(stub.close)
+        client = stub.Client('billing')
+        self.addCleanup(client.close)
+        job = client.new_job()
+        job.create_tax_receipt(tax_receipt={'event_id': '1'})
+        job.create_tax_receipt(tax_receipt={'event_id': '2'})
+
+        response = client.send_job(job)
+        result = stub.measure(5, receipts_per_job=3)
+
+        self.assertFalse(response.is_error())
+        self.assertEqual(len(response.actions), 2)
+        self.assertEqual(result['billing_jobs'], 5)
+        self.assertIn('billing_new_client_time', result)
+        self.assertIn('billing_reused_client_time', result)
+
+
 class TestGenerateEntryPoint(TestCase):
 
     def test_not_configured_country(self):
@@ -1442,6 +3371,15 @@ class TestGenerateEntryPoint(TestCase):
             my_exc.message
         )
 
+    def test_invalid_shard(self):
+        my_exc = InvalidShardException()
+        with self.assertRaises(CommandError) as cm:
+            call_command(generate_script_name, dry_run=True, country='AR', shards=2, shard_index=3)
+        self.assertEqual(
+            str(cm.exception),
+            my_exc.message
+        )
+
     @patch(
         'invoicing_app.tax_receipt_generator.TaxReceiptGenerator.run'
     )
@@ -0,0 +1,71 @@
+from timeit import default_timer
+import threading
+
+# Errors of a billing job rejected because of its auth token
+AUTH_ERRORS = ('UNAUTHORIZED', 'UNAUTHENTICATED', 'PERMISSION_DENIED', 'INVALID_TOKEN', 'TOKEN_EXPIRED')
+
+
+def is_auth_error(response):
+    """
+        True when billing rejected the job because of its auth token, the cached
+        token must not be used again.
+    """
+    if not response.is_error():
+        return False
+    details = [response.pretty_error()] + [action.error_detail for action in response.actions or []]
+    text = ' '.join(str(detail) for detail in details if detail).upper()
+    return any(error in text for error in AUTH_ERRORS)
+
+
+class TokenCache(object):
+    TTL = 300
+    REFRESH_MARGIN = 30
+
+    def __init__(self, fetch_token, ttl=None, refresh_margin=None):
+        """
+            fetch_token is called with the permissions passed to get_token and may
+            return the token itself or a dict with 'token' and 'expires_in' (seconds).
+        """
+        self._fetch_token = fetch_token
+        self._ttl = ttl if ttl else self.TTL
+        self._refresh_margin = refresh_margin if refresh_margin is not None else self.REFRESH_MARGIN
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, permissions):
+        key = self.__key(permissions)
+        cached = self._tokens.get(key)
+        if self.__is_fresh(cached):
+            return cached[0]
+
+        with self._lock:
+            # Another thread could have refreshed the token while we were waiting
+            cached = self._tokens.get(key)
+            if not self.__is_fresh(cached):
+                cached = self.__refresh(key, permissions)
+        return cached[0]
+
+    def invalidate(self, permissions=None):
+        with self._lock:
+            if permissions is None:
+                self._tokens.clear()
+            else:
+                self._tokens.pop(self.__key(permissions), None)
+
+    def __refresh(self, key, permissions):
+        token = self._fetch_token(permissions)
+        expires_in = self._ttl
+        if isinstance(token, dict):
+            expires_in = token.get('expires_in') or self._ttl
+            token = token['token']
+        cached = (token, default_timer() + expires_in)
+        self._tokens[key] = cached
+        return cached
+
+    def __is_fresh(self, cached):
+        return cached is not None and default_timer() < cached[1] - self._refresh_margin
+
+    def __key(self, permissions):
+        if isinstance(permissions, (list, tuple, set, frozenset)):
+            return tuple(sorted(permissions))
+        return (permissions,)